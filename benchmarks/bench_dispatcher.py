@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the Telegram fan-out dispatcher against a fake telegram.Bot.
+The fake bot answers after a fixed latency and raises RetryAfter for a small
+share of the calls. With --outbox the messages are journaled to a temporary
+SQLite outbox first. With --processes N the fake bot runs in N sender
+processes (see sender.py). Usage (from the repository root):
+
+    python benchmarks/bench_dispatcher.py --messages 5000 --rate 30 [--outbox] [--processes 2]
+"""
+
+import argparse, asyncio, os, random, sys, tempfile, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from telegram.error import RetryAfter
+from dispatcher import Dispatcher
+from outbox import Outbox
+from sender import ProcessBot
+
+
+class FakeBot:
+    """Stands in for telegram.Bot. Records every message it 'sends'."""
+
+    def __init__(self, latency, retry_share):
+        self.latency = latency
+        self.retry_share = retry_share
+        self.messages = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.latency)
+        if random.random() < self.retry_share:
+            raise RetryAfter(0.1)
+        self.messages.append((chat_id, text))
+
+
+class ProcessFakeBot(FakeBot):
+    """FakeBot built from ProcessBot's token argument inside a sender process."""
+
+    def __init__(self, token):
+        super().__init__(*token)
+
+
+async def run(args) -> None:
+    bot = FakeBot(args.latency, args.retry_share)
+    if args.processes:
+        # Latency & retry share reach the processes through the "token"
+        bot = ProcessBot((args.latency, args.retry_share), processes=args.processes, bot_class=ProcessFakeBot)
+        bot.start()
+    tmp_dir = tempfile.TemporaryDirectory()
+    outbox = Outbox(os.path.join(tmp_dir.name, "outbox.sqlite")) if args.outbox else None
+    dispatcher = Dispatcher(
+        bot,
+        workers=args.workers,
+        global_rate=args.rate,
+        report_interval=0,
+        outbox=outbox
+    )
+    await dispatcher.start()
+
+    # Time until all messages are queued = time on_message would be blocked
+    t0 = time.perf_counter()
+    for chat_id in range(args.messages):
+        await dispatcher.submit(chat_id, "Announcement")
+    t_submit = time.perf_counter() - t0
+
+    await dispatcher.stop()
+    t_total = time.perf_counter() - t0
+    if args.processes:
+        bot.stop()
+    stats = dispatcher.stats()
+
+    # Sequential baseline: what awaiting each send one by one would take
+    t_sequential = args.messages * args.latency
+
+    print(f"messages             {args.messages}")
+    print(f"workers / rate       {args.workers} / {args.rate} msg/s")
+    print(f"enqueue time         {t_submit:.3f}s")
+    print(f"total time           {t_total:.2f}s (sequential estimate {t_sequential:.2f}s)")
+    print(f"throughput           {stats['sent'] / t_total:.1f} msg/s")
+    print(f"retried              {stats['retried']}")
+    print(f"latency p50 / p99    {stats['latency p50']:.3f}s / {stats['latency p99']:.3f}s")
+    if outbox:
+        print(f"outbox backlog       {stats['backlog']} (drain rate {stats['drain rate']:.1f} msg/s)")
+        outbox.close()
+    tmp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=30, help="global msg/s limit")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake API latency (s)")
+    parser.add_argument("--retry-share", type=float, default=0.01)
+    parser.add_argument("--outbox", action="store_true", help="journal messages to SQLite")
+    parser.add_argument("--processes", type=int, default=0, help="sender processes (0: in-process)")
+    asyncio.run(run(parser.parse_args()))
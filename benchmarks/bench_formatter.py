@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of message_formatter.format_message() against the previous
+multi-pass helpers of send_to_TG over a few realistic Discord messages (long
+code blocks, many links, many mentions). Usage (from the repository root):
+
+    python benchmarks/bench_formatter.py --number 2000
+"""
+
+import argparse, os, re, sys, timeit
+from types import SimpleNamespace
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from message_formatter import format_message
+
+
+def legacy_format(content, guild) -> str:
+    """The five-pass helpers send_to_TG used before message_formatter existed."""
+
+    def add_html_hyperlinks(_str):
+        """Adds html hyperlink tags around any url starting with http or https."""
+        url_pattern = re.compile(r"""((https://|http://)[^ <>'"{}|\\^`[\]]*)""")
+        return url_pattern.sub(r"<a href='\1'>\1</a>", _str)
+
+    def resolve_usernames(_str, guild):
+        """Replaces mentions of user ids with their actual nicks/names."""
+
+        user_mention = r"<@[0-9]+>"
+        user_ids = re.findall(user_mention, _str)
+
+        # Replace each user id with a nickname or username
+        for id_match in user_ids:
+            id_int = int(id_match.strip('<>@'))
+            member = guild.get_member(id_int)
+            name = member.name
+            if member.nick: name = member.nick
+            _str = _str.replace(id_match, str("🌀<i>"+name+"</i>"))
+
+        return _str
+
+    def resolve_role_names(_str, guild):
+        """Replaces mentions of user ids with their actual nicks/names."""
+
+        role_mention = r"<@&[0-9]+>"
+        role_ids = re.findall(role_mention, _str)
+
+        # Replace each role id with its name
+        for id_match in role_ids:
+            id_int = int(id_match.strip('<>@&'))
+            role = guild.get_role(id_int)
+            name = role.name
+            _str = _str.replace(id_match, str("🌀<i>"+name+"</i>"))
+
+        return _str
+
+    def resolve_channels(_str, guild):
+        """Replaces mentions of user ids with their actual nicks/names."""
+
+        channel_mention = r"&lt;#[0-9]+&gt;"
+        channel_ids = re.findall(channel_mention, _str)
+
+        # Wrap a hyperlink around each channel id
+        for id_match in channel_ids:
+            id_int = int(id_match.strip('&lgt;#'))
+            channel = guild.get_channel_or_thread(id_int)
+            name = channel.name
+            url = channel.jump_url
+            _str = _str.replace(id_match, f"<a href='{url}'>{name}</a>")
+
+        return _str
+
+    def escape_chars(_str):
+        """
+        Replaces the HTML special character "&".
+        Replace "<", ">", "&" if not within HTML tags <b>, <i> and <a>.
+        """
+        # Replace "&" with "&amp;" everywhere
+        _str = re.sub("&", "&amp;", _str)
+
+        # Replace "<" with "&lt;" if not followed by "b>", "i>", "/", or "a"
+        lt_not_part_of_tag = "<(?!(b>|i>|u>|/|a))" # negative lookahead
+        _str = re.sub(lt_not_part_of_tag, "&lt;", _str)
+
+        # Replace ">" with "&gt;" if not preceded by "b", "i", "a", or "'"
+        gt_not_part_of_tag = "(?<!(b|i|a|u|'))>" # negative lookbehind
+        _str = re.sub(gt_not_part_of_tag, "&gt;", _str)
+
+        return _str
+
+    # Execute replacements (order matters to avoid double hyperlinking)
+
+    # Replace mentioned user ids with usernames
+    content = resolve_usernames(content, guild)
+    # Replace mentioned role ids with role names
+    content = resolve_role_names(content, guild)
+    # Replace special chars with their escape seqences
+    content = escape_chars(content)
+    # Convert urls in content to hyperlinks & concatenate msg back together
+    content = add_html_hyperlinks(content)
+    # Add hyperlinks around mentioned channels
+    content = resolve_channels(content, guild)
+
+    return content
+
+
+class FakeGuild:
+    """Resolves any member, role or channel id to a plausible object."""
+
+    def get_member(self, _id):
+        return SimpleNamespace(name=f"user{_id % 1000}", nick=None if _id % 2 else f"nick{_id % 100}")
+
+    def get_role(self, _id):
+        return SimpleNamespace(name=f"role{_id % 50}")
+
+    def get_channel_or_thread(self, _id):
+        return SimpleNamespace(name=f"channel{_id % 30}", jump_url=f"https://discord.com/channels/1/{_id}")
+
+
+CODE_BLOCK = "```py\nfor i in range(10):\n    if a < b and b > c & d:\n        print(i)\n```\n"
+
+CORPORA = {
+    "short chat": "gm <@123456789012345678>, check <#876543210987654321> & the docs!",
+    "long code block": "Here's the fix:\n" + 40 * CODE_BLOCK + "Thoughts <@123456789012345678>?",
+    "many links": " ".join(f"https://docs.jediswap.xyz/page/{i}?ref=discord&x={i}" for i in range(60)),
+    "many mentions": " ".join(
+        f"<@{100000000000000000 + i}> <@&{200000000000000000 + i}> <#{300000000000000000 + i}>"
+        for i in range(60)
+    ),
+}
+
+
+def main(number) -> None:
+    guild = FakeGuild()
+    print(f"{'corpus':<18}{'chars':>8}{'legacy µs':>12}{'single-pass µs':>17}{'speedup':>10}")
+
+    for name, content in CORPORA.items():
+        t_old = timeit.timeit(lambda: legacy_format(content, guild), number=number)
+        t_new = timeit.timeit(lambda: format_message(content, guild), number=number)
+        print(
+            f"{name:<18}{len(content):>8}{t_old / number * 1e6:>12.1f}"
+            f"{t_new / number * 1e6:>17.1f}{t_old / t_new:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--number", type=int, default=2000, help="runs per corpus")
+    main(parser.parse_args().number)
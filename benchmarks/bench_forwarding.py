@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmark of the Discord -> Telegram forwarding path. Message
+streams are replayed into DiscordBot.handle_message() (the body of
+on_message) with fake discord.Message / Guild objects; the notifications go
+through the real Dispatcher into a recording fake telegram.Bot. Reports
+messages/s, Telegram messages/s, p50/p99 latency (also of the matching engine
+alone) and memory allocations for these scenarios on a guild with --users
+subscribers:
+
+    mentions        every message mentions a few members
+    roles           heavy role mentions, the big roles are held by thousands
+    announcements   messages in an always active channel, sent to everyone
+
+Recorded streams (one JSON message per line, see load_stream) can be
+replayed with --replay. Usage (from the repository root):
+
+    python benchmarks/bench_forwarding.py --users 10000 [--scenario roles] [--outbox]
+"""
+
+import argparse, asyncio, datetime, itertools, json, os, random, sys, tempfile, time, tracemalloc
+from collections import deque
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+GUILD_ID = 1
+ANNOUNCEMENTS_ID = 299
+# Messages per scenario if --messages isn't given. Broadcasts fan out to everyone.
+DEFAULT_MESSAGES = {"mentions": 2000, "roles": 200, "announcements": 10, "replay": None}
+LOREM = "Has anyone tried the new release? See https://example.com/changelog for details & more. "
+
+
+class FakeRole:
+    def __init__(self, id, name):
+        self.id, self.name = id, name
+
+
+class FakeMember:
+    def __init__(self, id, name, roles):
+        self.id, self.name, self.nick = id, name, None
+        self.discriminator, self.display_name = "0001", name
+        self.roles = roles
+
+
+class FakeChannel:
+    def __init__(self, id, name):
+        self.id, self.name = id, name
+        self.type, self.category_id = "text", 1
+        self.jump_url = f"https://discord.com/channels/{GUILD_ID}/{id}"
+
+
+class FakeGuild:
+    """The parts of discord.Guild used by the bot & the message formatter."""
+
+    def __init__(self, n_members, n_roles, n_channels):
+        self.id, self.name = GUILD_ID, "Bench guild"
+        # @everyone has the guild id as role id
+        self.default_role = FakeRole(GUILD_ID, "@everyone")
+        self.roles = [self.default_role] + [FakeRole(100 + i, f"role-{i}") for i in range(n_roles)]
+        self.channels = [FakeChannel(200 + i, f"channel-{i}") for i in range(n_channels)]
+        self.channels.append(FakeChannel(ANNOUNCEMENTS_ID, "announcements"))
+        self.members = [FakeMember(10000 + i, f"user{i}", [self.default_role]) for i in range(n_members)]
+        self.member_map = {m.id: m for m in self.members}
+        self.role_map = {r.id: r for r in self.roles}
+        self.channel_map = {c.id: c for c in self.channels}
+
+    def get_member(self, member_id):
+        return self.member_map.get(member_id)
+
+    def get_role(self, role_id):
+        return self.role_map.get(role_id)
+
+    def get_channel(self, channel_id):
+        return self.channel_map.get(channel_id)
+
+    get_channel_or_thread = get_channel
+
+    def get_member_named(self, name):
+        return next((m for m in self.members if m.name == name), None)
+
+
+class FakeClient:
+    def __init__(self, guild):
+        self.guild = guild
+
+    def get_guild(self, guild_id):
+        return self.guild if guild_id == self.guild.id else None
+
+
+class FakeMessage:
+    """The parts of discord.Message read by handle_message()."""
+
+    def __init__(self, id, guild, channel, author, content, mentions=(), role_mentions=(), everyone=False):
+        self.id, self.guild, self.channel, self.author = id, guild, channel, author
+        self.content = content
+        self.mentions, self.role_mentions = list(mentions), list(role_mentions)
+        self.mention_everyone = everyone
+        self.jump_url = f"{channel.jump_url}/{id}"
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+
+
+class RecordingBot:
+    """Stands in for telegram.Bot. Counts the messages 'sent' & their characters."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.sent, self.characters = 0, 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent += 1
+        self.characters += len(text)
+
+
+def populate(bot, guild, n_users, whitelist_share, digest_share=0) -> None:
+    """
+    Registers one verified Telegram user per guild member. Role membership is
+    skewed: role-0 is held by about half of all users, role-1 by a third, ...
+    Some users only follow a few whitelisted channels, some get digests.
+    """
+    roles = guild.roles[1:]
+    channel_ids = [c.id for c in guild.channels if c.id != ANNOUNCEMENTS_ID]
+    for i, member in enumerate(guild.members[:n_users]):
+        held = [role for rank, role in enumerate(roles) if random.random() < 1 / (rank + 2)]
+        member.roles = [guild.default_role] + held
+        channels = set(random.sample(channel_ids, 3)) if random.random() < whitelist_share else set()
+        bot.update_user(1000000 + i, {
+            "discord guild": GUILD_ID,
+            "discord handle": member.name,
+            "discord id": member.id,
+            "discord roles": {role.name for role in held},
+            "discord channels": channels,
+            "verified discord": True,
+            "digest minutes": 15 if random.random() < digest_share else None,
+        })
+
+
+def make_stream(scenario, guild, n_messages) -> list:
+    """Synthetic messages of a scenario."""
+    ids = itertools.count(1)
+    channels = [c for c in guild.channels if c.id != ANNOUNCEMENTS_ID]
+    announcements = guild.get_channel(ANNOUNCEMENTS_ID)
+    stream = []
+
+    for _ in range(n_messages):
+        author = random.choice(guild.members)
+        channel = random.choice(channels)
+
+        if scenario == "mentions":
+            mentions = random.sample(guild.members, random.randint(1, 5))
+            content = " ".join(f"<@{m.id}>" for m in mentions) + f" in <#{channel.id}>: " + LOREM
+            stream.append(FakeMessage(next(ids), guild, channel, author, content, mentions=mentions))
+
+        elif scenario == "roles":
+            # Mostly the big roles, now and then @everyone on top
+            roles = random.sample(guild.roles[1:6], random.randint(1, 3))
+            everyone = random.random() < 0.1
+            content = " ".join(f"<@&{r.id}>" for r in roles) + (" @everyone " if everyone else " ") + LOREM
+            stream.append(FakeMessage(next(ids), guild, channel, author, content, role_mentions=roles, everyone=everyone))
+
+        else:
+            stream.append(FakeMessage(next(ids), guild, announcements, author, LOREM * 4))
+
+    return stream
+
+
+def load_stream(path, guild) -> list:
+    """
+    Reads recorded messages, one JSON object per line, i.e.
+    {"content": "...", "channel": 200, "author": 10001, "mentions": [10002],
+     "role_mentions": [101], "everyone": false}. Ids refer to the fake guild:
+    members from 10000, roles from 100, channels from 200 (299: announcements).
+    """
+    stream = []
+    with open(path) as f:
+        for message_id, line in enumerate((line for line in f if line.strip()), 1):
+            data = json.loads(line)
+            stream.append(FakeMessage(
+                message_id, guild,
+                guild.get_channel(data.get("channel", 200)),
+                guild.get_member(data.get("author", 10000)),
+                data.get("content", ""),
+                mentions=[guild.get_member(i) for i in data.get("mentions", []) if guild.get_member(i)],
+                role_mentions=[guild.get_role(i) for i in data.get("role_mentions", []) if guild.get_role(i)],
+                everyone=data.get("everyone", False)
+            ))
+    return stream
+
+
+async def replay(bot, stream, args, trace=False) -> dict:
+    """Feeds the stream into handle_message() & waits until every notification was sent."""
+    from dispatcher import Dispatcher
+
+    fake_bot = RecordingBot(args.latency)
+    # No Telegram rate limits, the forwarding path itself is measured
+    bot.dispatcher = Dispatcher(
+        fake_bot,
+        workers=args.workers,
+        global_rate=1e9,
+        chat_rate=1e9,
+        chat_burst=1e9,
+        on_forbidden=bot.remove_blocked_user,
+        report_interval=0,
+        outbox=bot.outbox if args.outbox else None
+    )
+    # Keep every delivery latency, not just the last 1000 (not while counting allocations)
+    if not trace:
+        bot.dispatcher.latencies = deque()
+    bot.rendered_messages.clear()
+    await bot.dispatcher.start()
+
+    if trace:
+        tracemalloc.start()
+        before, _ = tracemalloc.get_traced_memory()
+
+    handle_times = []
+    interval = 1 / args.rate if args.rate else 0
+    t0 = time.perf_counter()
+    for i, message in enumerate(stream):
+        if interval:
+            await asyncio.sleep(max(0.0, t0 + i * interval - time.perf_counter()))
+        message.created_at = datetime.datetime.now(datetime.timezone.utc)
+        started = time.perf_counter()
+        await bot.handle_message(message)
+        handle_times.append(time.perf_counter() - started)
+    t_feed = time.perf_counter() - t0
+
+    # Close all digest windows right away
+    buffered = len(bot.digests)
+    await bot.flush_digests(everything=True)
+
+    await bot.dispatcher.stop()
+    t_total = time.perf_counter() - t0
+
+    result = {
+        "messages": len(stream),
+        "notifications": fake_bot.sent,
+        "buffered": buffered,
+        "feed time": t_feed,
+        "total time": t_total,
+        "handle times": sorted(handle_times),
+        "delivery latencies": sorted(bot.dispatcher.latencies),
+    }
+    if trace:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result.update({"peak": peak - before, "retained": current - before})
+    return result
+
+
+def time_matching(bot, stream) -> list:
+    """Sorted durations of the matching engine alone (no rendering, no sending) per message."""
+    from matching import MessageInfo, match_message
+
+    always_active = frozenset({ANNOUNCEMENTS_ID})
+    times = []
+    for message in stream:
+        info = MessageInfo.from_message(message)
+        started = time.perf_counter()
+        match_message(bot.get_subscriptions(), info, always_active)
+        times.append(time.perf_counter() - started)
+    return sorted(times)
+
+
+def percentile(values, p) -> float:
+    return values[int(p * (len(values) - 1))] if values else 0.0
+
+
+async def run(args) -> None:
+    # The bot reads its config from the environment & writes its files to cwd
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": "123456:bench",
+        "DEFAULT_GUILD": str(GUILD_ID),
+        "ALWAYS_ACTIVE_CHANNELS": f"[{ANNOUNCEMENTS_ID}]",
+        "SENDER_PROCESSES": "0",
+    })
+    tmp_dir = tempfile.TemporaryDirectory()
+    os.chdir(tmp_dir.name)
+    from discord_bot import DiscordBot
+    random.seed(args.seed)
+
+    guild = FakeGuild(max(args.users, 1), args.roles, args.channels)
+    bot = DiscordBot()
+    bot.outbox = bot.dispatcher.outbox
+    bot.client = FakeClient(guild)
+
+    t0 = time.perf_counter()
+    populate(bot, guild, args.users, args.whitelist_share, args.digest_share)
+    print(f"users                {args.users} ({time.perf_counter() - t0:.2f}s to index)")
+    print(f"outbox               {'on' if args.outbox else 'off'}, fake API latency {args.latency * 1e3:.0f} ms")
+
+    if args.replay:
+        scenarios = {"replay": load_stream(args.replay, guild)}
+    else:
+        names = [args.scenario] if args.scenario else ["mentions", "roles", "announcements"]
+        scenarios = {
+            name: make_stream(name, guild, args.messages or DEFAULT_MESSAGES[name]) for name in names
+        }
+
+    for name, stream in scenarios.items():
+        result = await replay(bot, stream, args)
+        # Allocations on a separate run, tracemalloc slows everything down a lot
+        traced = await replay(bot, stream[:args.trace_messages], args, trace=True)
+        n_traced = max(traced["messages"], 1)
+        matching = time_matching(bot, stream)
+
+        handle, delivery = result["handle times"], result["delivery latencies"]
+        print(f"\n[{name}]")
+        print(f"messages             {result['messages']} -> {result['notifications']} Telegram messages")
+        if result["buffered"]:
+            print(f"digests              {result['buffered']} notifications buffered")
+        print(f"messages/s           {result['messages'] / result['feed time']:.1f}")
+        print(f"notifications/s      {result['notifications'] / result['total time']:.1f}")
+        print(f"on_message p50 / p99 {percentile(handle, 0.5) * 1e3:.3f} ms / {percentile(handle, 0.99) * 1e3:.3f} ms")
+        print(f"matching p50 / p99   {percentile(matching, 0.5) * 1e3:.3f} ms / {percentile(matching, 0.99) * 1e3:.3f} ms")
+        print(f"delivery p50 / p99   {percentile(delivery, 0.5) * 1e3:.1f} ms / {percentile(delivery, 0.99) * 1e3:.1f} ms")
+        print(f"allocations          peak {traced['peak'] / 1024:.0f} KiB, "
+              f"retained {traced['retained'] / n_traced / 1024:.1f} KiB/message ({n_traced} messages)")
+
+    if args.outbox:
+        bot.outbox.close()
+    tmp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--roles", type=int, default=20)
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--whitelist-share", type=float, default=0.3, help="users with a channel whitelist")
+    parser.add_argument("--digest-share", type=float, default=0, help="users in digest mode")
+    parser.add_argument("--scenario", choices=["mentions", "roles", "announcements"])
+    parser.add_argument("--messages", type=int, help="messages per scenario (default depends on scenario)")
+    parser.add_argument("--replay", help="JSON lines file of recorded messages to replay")
+    parser.add_argument("--rate", type=float, default=0, help="incoming msg/s (0: as fast as possible)")
+    parser.add_argument("--workers", type=int, default=64)
+    parser.add_argument("--latency", type=float, default=0, help="fake API latency (s)")
+    parser.add_argument("--outbox", action="store_true", help="journal notifications to SQLite")
+    parser.add_argument("--trace-messages", type=int, default=50, help="messages replayed under tracemalloc")
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
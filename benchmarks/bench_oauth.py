@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measures how long the event loop is blocked while many users verify their
+Discord login at once. A local stub server stands in for Discord's OAuth2
+endpoints and answers after a fixed delay. The async DiscordOAuth client is
+compared with blocking requests as made before. Usage (from the repository
+root):
+
+    python benchmarks/bench_oauth.py --users 50 --delay 0.2
+"""
+
+import argparse, asyncio, json, os, sys, threading, time, urllib.parse, urllib.request
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aiohttp import web
+from oauth import DiscordOAuth
+
+
+def start_stub_server(delay, port) -> None:
+    """
+    Fake Discord API: /oauth2/token & /users/@me, each answering after delay.
+    Runs in a thread with its own loop, so a blocked main loop can't stall it.
+    """
+
+    async def token(request):
+        await asyncio.sleep(delay)
+        return web.json_response({"access_token": "token"})
+
+    async def user(request):
+        await asyncio.sleep(delay)
+        return web.json_response({"id": "1234", "username": "tom", "discriminator": "0001"})
+
+    async def serve():
+        app = web.Application()
+        app.add_routes([web.post("/api/oauth2/token", token), web.get("/api/users/@me", user)])
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        await asyncio.Event().wait()
+
+    threading.Thread(target=asyncio.run, args=(serve(),), daemon=True).start()
+
+
+async def measure_loop_lag(stop, interval=0.01) -> float:
+    """Returns the longest time the loop took longer than interval to wake us up."""
+    max_lag = 0.0
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        await asyncio.sleep(interval)
+        max_lag = max(max_lag, time.perf_counter() - t0 - interval)
+    return max_lag
+
+
+def blocking_get_user(api_url) -> dict:
+    """What set_verification_status did before: two blocking requests."""
+    data = urllib.parse.urlencode({"code": "abc"}).encode()
+    with urllib.request.urlopen(api_url + "/oauth2/token", data=data) as response:
+        access_token = json.load(response)["access_token"]
+    request = urllib.request.Request(api_url + "/users/@me", headers={"Authorization": f"Bearer {access_token}"})
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)
+
+
+async def run_scenario(name, verify, users) -> None:
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_loop_lag(stop))
+    t0 = time.perf_counter()
+    await asyncio.gather(*(verify() for _ in range(users)))
+    elapsed = time.perf_counter() - t0
+    stop.set()
+    print(f"{name:<22}{elapsed:>10.2f}s{await lag_task:>16.3f}s")
+
+
+async def main(args) -> None:
+    api_url = f"http://127.0.0.1:{args.port}/api"
+    start_stub_server(args.delay, args.port)
+    await asyncio.sleep(0.5)
+
+    print(f"{args.users} concurrent verifications, {args.delay}s per request\n")
+    print(f"{'client':<22}{'total':>11}{'max loop block':>17}")
+
+    oauth = DiscordOAuth("id", "secret", "uri", api_url=api_url, max_concurrent=args.concurrency)
+    await run_scenario("async (DiscordOAuth)", lambda: oauth.get_user("abc"), args.users)
+    await oauth.close()
+
+    async def blocking():
+        return blocking_get_user(api_url)
+
+    await run_scenario("blocking (requests)", blocking, args.users)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--delay", type=float, default=0.2, help="stub server delay (s)")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--port", type=int, default=8765)
+    asyncio.run(main(parser.parse_args()))
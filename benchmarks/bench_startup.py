@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Startup benchmark: import time (python -X importtime) & peak RSS of the
+modules main.py loads before the bots go online. Time-to-ready of both bots
+is logged by main.py itself ("... after start"). Usage (from the repository
+root):
+
+    python benchmarks/bench_startup.py --top 15
+"""
+
+import argparse, os, re, subprocess, sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Same imports as main.py, then print peak RSS of the child process (kB on Linux)
+CODE = (
+    "import resource, telegram_bot, discord_bot;"
+    "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)"
+)
+LINE_PATTERN = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def main(top, runs) -> None:
+    totals, rss = [], []
+
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", CODE],
+            cwd=ROOT, capture_output=True, text=True, check=True
+        )
+        # Cumulative time of top level imports (indentation of one space)
+        imports = []
+        for line in result.stderr.splitlines():
+            match = LINE_PATTERN.match(line)
+            if match:
+                imports.append((int(match.group(2)), len(match.group(3)), match.group(4)))
+        totals.append(sum(us for us, depth, _ in imports if depth == 1))
+        rss.append(int(result.stdout.strip()))
+
+    print(f"import time (best of {runs})   {min(totals) / 1e3:.0f} ms")
+    print(f"peak RSS                   {min(rss) / 1024:.1f} MB")
+    # Packages imported by the bot modules themselves (indentation of three spaces)
+    print(f"\nSlowest imports of the bot modules (last run, cumulative):")
+    for us, _, name in sorted((i for i in imports if i[1] == 3), reverse=True)[:top]:
+        print(f"  {us / 1e3:8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--top", type=int, default=15, help="number of imports listed")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+    main(args.top, args.runs)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load test of the Telegram bot in webhook mode. A local stub server stands in
+for the Telegram API. Updates are posted to the bot's webhook listener, like
+Telegram would do, and the time until the stub receives the bot's reply is
+measured per update. Each user sends /start then /menu by default. Recorded
+updates (one JSON update per line) can be replayed with --updates. Usage
+(from the repository root):
+
+    python benchmarks/bench_webhook.py --users 200 --concurrent-updates 16
+"""
+
+import argparse, asyncio, itertools, json, os, sys, tempfile, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from aiohttp import ClientSession, web
+
+TOKEN = "123456:bench"
+
+
+def make_update(update_id, user_id, text) -> dict:
+    """A private chat message update as Telegram would post it."""
+    entities = [{"type": "bot_command", "offset": 0, "length": len(text)}] if text.startswith("/") else []
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": f"user{user_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text,
+            "entities": entities,
+        },
+    }
+
+
+def stub_telegram_api(replies) -> web.Application:
+    """Fake Telegram Bot API. Appends (chat id, time) to replies for every message sent."""
+
+    async def method(request):
+        name = request.match_info["method"]
+        data = dict(await request.post()) if request.content_type != "application/json" else await request.json()
+
+        if name == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif name in ("sendMessage", "editMessageText"):
+            chat_id = int(data.get("chat_id", 0))
+            replies.append((chat_id, time.perf_counter()))
+            result = {
+                "message_id": len(replies), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "text": data.get("text", ""),
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application()
+    app.add_routes([web.post(f"/bot{TOKEN}/{{method}}", method)])
+    return app
+
+
+async def run(args) -> None:
+    # The bots read their config from the environment & write their files to cwd
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": TOKEN,
+        "DEFAULT_GUILD": "1",
+        "CONCURRENT_UPDATES": str(args.concurrent_updates),
+    })
+    tmp_dir = tempfile.TemporaryDirectory()
+    os.chdir(tmp_dir.name)
+    from discord_bot import DiscordBot
+    from telegram_bot import TelegramBot
+
+    if args.updates:
+        with open(args.updates) as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        ids = itertools.count(1)
+        updates = [
+            make_update(next(ids), user_id, text)
+            for user_id in range(1000, 1000 + args.users) for text in ("/start", "/menu")
+        ]
+
+    # Telegram API stand-in
+    replies = []
+    runner = web.AppRunner(stub_telegram_api(replies))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.api_port).start()
+
+    # Bot in webhook mode, talking to the stand-in
+    tg_bot = TelegramBot(DiscordBot())
+    app = tg_bot.build_application(base_url=f"http://127.0.0.1:{args.api_port}/bot")
+    webhook_url = f"http://127.0.0.1:{args.webhook_port}/telegram"
+
+    async with app:
+        await app.start()
+        await app.updater.start_webhook(
+            listen="127.0.0.1", port=args.webhook_port, url_path="telegram", webhook_url=webhook_url
+        )
+
+        # Updates of one chat are posted in order, chats in parallel
+        by_chat = {}
+        for update in updates:
+            chat_id = update.get("message", update.get("callback_query", {})).get("chat", {}).get("id")
+            by_chat.setdefault(chat_id, []).append(update)
+        posted = {}
+
+        async with ClientSession() as session:
+
+            async def post_chat(chat_id, chat_updates):
+                for update in chat_updates:
+                    posted.setdefault(chat_id, []).append(time.perf_counter())
+                    async with session.post(webhook_url, json=update) as response:
+                        await response.read()
+
+            t0 = time.perf_counter()
+            await asyncio.gather(*(post_chat(c, u) for c, u in by_chat.items()))
+
+            # Every update gets (at least) one reply
+            while len(replies) < len(updates) and time.perf_counter() - t0 < args.timeout:
+                await asyncio.sleep(0.05)
+            t_total = time.perf_counter() - t0
+
+        await app.updater.stop()
+        await app.stop()
+    await runner.cleanup()
+
+    # Latency: n-th reply of a chat vs. n-th update posted for it
+    replied = {}
+    for chat_id, at in replies:
+        replied.setdefault(chat_id, []).append(at)
+    latencies = sorted(
+        r - p for chat_id, times in posted.items() for p, r in zip(times, replied.get(chat_id, []))
+    )
+
+    def percentile(p):
+        return latencies[int(p * (len(latencies) - 1))] if latencies else 0.0
+
+    print(f"updates / chats      {len(updates)} / {len(by_chat)}")
+    print(f"concurrent updates   {args.concurrent_updates}")
+    print(f"replies              {len(replies)}")
+    print(f"total time           {t_total:.2f}s")
+    print(f"throughput           {len(replies) / t_total:.1f} updates/s")
+    print(f"latency p50 / p99    {percentile(0.5):.3f}s / {percentile(0.99):.3f}s")
+    tmp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--updates", help="JSON lines file of recorded updates to replay")
+    parser.add_argument("--concurrent-updates", type=int, default=16)
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--webhook-port", type=int, default=8082)
+    parser.add_argument("--timeout", type=float, default=600)
+    asyncio.run(run(parser.parse_args()))
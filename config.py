@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In this file the configuration read from the .env file is defined. It is
+parsed once into a Config object instead of on every Discord message or menu
+interaction. Send SIGHUP to the process to reload it without a restart.
+"""
+
+import json, os, signal
+from dataclasses import dataclass
+from typing import FrozenSet, Mapping, Optional
+from dotenv import load_dotenv
+from logs import get_logger
+
+logger = get_logger("config")
+
+
+@dataclass(frozen=True)
+class Config:
+    """Typed, immutable snapshot of the environment configuration."""
+
+    discord_token: str
+    telegram_bot_token: str
+    oauth_client_id: str
+    oauth_client_secret: str
+    oauth_redirect_uri: str
+    default_guild: int
+    allowed_channel_categories: FrozenSet[int]
+    roles_exempt_by_default: FrozenSet[str]
+    always_active_channels: FrozenSet[int]
+    debug_id: Optional[int]
+    metrics_port: Optional[int]
+    sender_processes: int
+    telegram_webhook_url: Optional[str]
+    webhook_listen: str
+    webhook_port: int
+    webhook_secret: Optional[str]
+    concurrent_updates: int
+    log_levels: Mapping[str, str]
+    log_sample_rates: Mapping[str, float]
+
+
+def parse_list(name, cast) -> frozenset:
+    """Parses an env variable holding a json list, i.e. '[1, 2, 3]'. Missing -> empty."""
+    value = os.getenv(name)
+    return frozenset(cast(x) for x in json.loads(value)) if value else frozenset()
+
+
+def parse_dict(name, cast) -> dict:
+    """Parses an env variable holding a json object, i.e. '{"a": 1}'. Missing -> empty."""
+    value = os.getenv(name)
+    return {k: cast(v) for k, v in json.loads(value).items()} if value else {}
+
+
+def load_config(override=False) -> Config:
+    """Reads the .env file & returns a new Config. On reload, .env values win."""
+    load_dotenv("./.env", override=override)
+    debug_id = os.getenv("DEBUG_ID")
+    metrics_port = os.getenv("METRICS_PORT")
+
+    return Config(
+        discord_token=os.getenv("DISCORD_TOKEN"),
+        telegram_bot_token=os.getenv("TELEGRAM_BOT_TOKEN"),
+        oauth_client_id=os.getenv("OAUTH_DISCORD_CLIENT_ID"),
+        oauth_client_secret=os.getenv("OAUTH_DISCORD_CLIENT_SECRET"),
+        oauth_redirect_uri=os.getenv("OAUTH_REDIRECT_URI"),
+        default_guild=int(os.getenv("DEFAULT_GUILD")),
+        allowed_channel_categories=parse_list("ALLOWED_CHANNEL_CATEGORIES", int),
+        roles_exempt_by_default=parse_list("ROLES_EXEMPT_BY_DEFAULT", str),
+        always_active_channels=parse_list("ALWAYS_ACTIVE_CHANNELS", int),
+        debug_id=int(debug_id) if debug_id and debug_id.isdigit() else None,
+        metrics_port=int(metrics_port) if metrics_port else None,
+        sender_processes=int(os.getenv("SENDER_PROCESSES") or 0),
+        telegram_webhook_url=os.getenv("TELEGRAM_WEBHOOK_URL") or None,
+        webhook_listen=os.getenv("WEBHOOK_LISTEN") or "127.0.0.1",
+        webhook_port=int(os.getenv("WEBHOOK_PORT") or 8443),
+        webhook_secret=os.getenv("WEBHOOK_SECRET") or None,
+        concurrent_updates=int(os.getenv("CONCURRENT_UPDATES") or 16),
+        log_levels=parse_dict("LOG_LEVELS", str.upper),
+        log_sample_rates=parse_dict("LOG_SAMPLE_RATES", float),
+    )
+
+
+_config = None
+
+
+def get_config() -> Config:
+    """Returns the current Config. Loaded on first use."""
+    global _config
+    if _config is None:
+        _config = load_config()
+    return _config
+
+
+def reload_config() -> None:
+    """Re-reads the .env file. A broken file keeps the previous config."""
+    global _config
+    try:
+        _config = load_config(override=True)
+        logger.info("Reloaded config")
+    except (TypeError, ValueError) as e:
+        logger.warning("Config reload failed, keeping previous config: %r", e)
+
+
+def reload_on_sighup(loop) -> None:
+    """Registers reload_config() as SIGHUP handler of the given event loop."""
+    if hasattr(signal, "SIGHUP"):
+        loop.add_signal_handler(signal.SIGHUP, reload_config)
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In this file the digest delivery mode is defined. Instead of one Telegram
+message per Discord message, users in digest mode get their notifications
+buffered and sent as one combined message every N minutes. Digests longer
+than Telegram's message limit are split between notifications (or within
+a notification too long on its own). Buffered notifications are journaled
+in the outbox database, so a crash doesn't lose them.
+"""
+
+import re
+import time
+from typing import Dict, List
+
+# Telegram's limit, counted in UTF-16 code units (emojis count twice)
+MAX_MESSAGE_LENGTH = 4096
+SEPARATOR = "\n\n~~~~~~~~~~~~~~~~~~~~~~\n\n"
+# Pieces of HTML a message can't be cut into: Tags, entities & single characters
+ATOM = re.compile(r"(?P<tag><(?P<closing>/?)(?P<name>\w+)[^<>]*>)|&#?\w+;|.", re.DOTALL)
+TAG = re.compile(r"<[^<>]*>")
+
+
+def telegram_length(text) -> int:
+    """Length of a text as Telegram counts it."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def split_entry(entry, limit=MAX_MESSAGE_LENGTH) -> List[str]:
+    """
+    Cuts a rendered notification (HTML) into chunks within limit. Cuts go after
+    the last line break or else space outside of any HTML element, never into a
+    tag or entity. An element longer than the limit itself (i.e. a long link)
+    is cut with its tags closed before & reopened after the cut, or, if even
+    its tags are too long for that, the rest of the notification goes as plain
+    text. Either way every chunk is valid HTML on its own.
+    """
+    chunks = []
+
+    while telegram_length(entry) > limit:
+        length = 0
+        # Elements open at the current position [(opening tag, name)] & length of their closing tags
+        open_tags, closing_length = [], 0
+        # Last possible cut after a line break, a space, anything outside of an element
+        line_cut = space_cut = outside_cut = None
+        # Last possible cut inside an element & the elements open there
+        inside_cut, inside_tags = None, ()
+
+        for atom in ATOM.finditer(entry):
+            text = atom.group()
+            length += telegram_length(text)
+
+            if atom.group("tag") and not text.endswith("/>"):
+                if not atom.group("closing"):
+                    open_tags.append((text, atom.group("name")))
+                    closing_length += telegram_length(f"</{atom.group('name')}>")
+                elif open_tags:
+                    closing_length -= telegram_length(f"</{open_tags.pop()[1]}>")
+
+            # Chunk ending here incl. the closing tags of all open elements
+            if length + closing_length > limit:
+                break
+
+            if open_tags:
+                inside_cut, inside_tags = atom.end(), tuple(open_tags)
+                continue
+            outside_cut = atom.end()
+            if text == "\n":
+                line_cut = atom.end()
+            elif text == " ":
+                space_cut = atom.end()
+
+        cut = line_cut or space_cut or outside_cut
+        reopened = "".join(tag for tag, _ in inside_tags)
+
+        # Possibility: Element longer than the limit -> Close its tags & reopen them after the cut
+        if not cut and inside_cut and telegram_length(reopened) <= limit // 2:
+            closed = "".join(f"</{name}>" for _, name in reversed(inside_tags))
+            chunks.append(entry[:inside_cut] + closed)
+            entry = reopened + entry[inside_cut:]
+            continue
+
+        # Possibility: Not even the tags fit twice -> Rest as plain text (entities stay escaped)
+        if not cut:
+            entry = TAG.sub("", entry)
+            continue
+
+        chunk = entry[:cut].rstrip()
+        if chunk:
+            chunks.append(chunk)
+        entry = entry[cut:].lstrip()
+
+    if entry:
+        chunks.append(entry)
+    return chunks
+
+
+def split_digest(entries, title="") -> List[str]:
+    """
+    Joins rendered notifications (HTML) into as few messages as possible, each
+    within MAX_MESSAGE_LENGTH. Messages are split between notifications, a
+    notification too long for one message is cut with split_entry(). The title
+    goes on top of the first message, never on a message of its own.
+    """
+    messages = []
+    current, current_length = title, telegram_length(title)
+    # Leaves room for the title, so the first chunk always fits below it
+    limit = MAX_MESSAGE_LENGTH - telegram_length(title + SEPARATOR) if title else MAX_MESSAGE_LENGTH
+
+    for entry in entries:
+        for chunk in split_entry(entry.strip(), limit):
+            length = telegram_length(chunk)
+            separator = SEPARATOR if current else ""
+
+            # Possibility: Doesn't fit anymore -> Start a new message
+            if current and current_length + telegram_length(separator) + length > MAX_MESSAGE_LENGTH:
+                messages.append(current)
+                current, current_length = chunk, length
+            else:
+                current += separator + chunk
+                current_length += telegram_length(separator) + length
+
+    if current:
+        messages.append(current)
+    return messages
+
+
+class DigestBuffer:
+    """
+    Notifications per Telegram user waiting for the end of their digest window.
+    With a journal (an Outbox) they are journaled until sent(), see restore().
+    """
+
+    def __init__(self, journal=None):
+        # {telegram id: [rendered notifications]}
+        self.entries = {}
+        # {telegram id: time.time() the window closes}, wall clock so it survives restarts
+        self.due = {}
+        self.journal = journal
+        # Journal ids {telegram id: [id]} of the buffered & of the taken, not yet sent notifications
+        self.journal_ids = {}
+        self.taken_ids = {}
+
+
+    def __len__(self) -> int:
+        """Number of buffered notifications."""
+        return sum(len(entries) for entries in self.entries.values())
+
+
+    def restore(self) -> None:
+        """Buffers the notifications journaled before the last shutdown or crash again."""
+        for row_id, chat_id, text, due_at in self.journal.load_digests():
+            self.entries.setdefault(chat_id, []).append(text)
+            self.journal_ids.setdefault(chat_id, []).append(row_id)
+            self.due.setdefault(chat_id, due_at)
+
+
+    def add(self, chat_id, text, minutes) -> None:
+        """Buffers a notification. The first one of a window starts it."""
+        if chat_id not in self.entries:
+            self.entries[chat_id] = []
+            self.due[chat_id] = time.time() + minutes * 60
+        self.entries[chat_id].append(text)
+        if self.journal:
+            row_id = self.journal.add_digest(chat_id, text, self.due[chat_id])
+            self.journal_ids.setdefault(chat_id, []).append(row_id)
+
+
+    def discard(self, chat_id) -> None:
+        """Drops everything buffered for a user."""
+        self.entries.pop(chat_id, None)
+        self.due.pop(chat_id, None)
+        if self.journal:
+            self.journal.drop_digests(self.journal_ids.pop(chat_id, []))
+
+
+    def release(self, chat_id) -> None:
+        """Closes a user's window now, i.e. after switching back to immediate delivery."""
+        if chat_id in self.due:
+            self.due[chat_id] = 0
+            if self.journal:
+                self.journal.set_digest_due(chat_id, 0)
+
+
+    def take_due(self, everything=False) -> Dict[int, List[str]]:
+        """
+        Removes & returns {telegram id: [notifications]} of all closed windows.
+        They stay journaled until sent() is called for the user.
+        """
+        now = time.time()
+        due = [chat_id for chat_id, at in self.due.items() if everything or at <= now]
+        taken = {}
+        for chat_id in due:
+            taken[chat_id] = self.entries.pop(chat_id)
+            del self.due[chat_id]
+            if chat_id in self.journal_ids:
+                self.taken_ids[chat_id] = self.journal_ids.pop(chat_id)
+        return taken
+
+
+    def sent(self, chat_id) -> None:
+        """Drops a taken digest from the journal, call once its messages are queued."""
+        if self.journal:
+            self.journal.drop_digests(self.taken_ids.pop(chat_id, []))
@@ -3,226 +3,555 @@
 """
 In this file the DiscordBot class is defined. DiscordBot instantiates a
 Telegram bot of its own to forward the Discord messages to Telegram.
-Messages forwarded using send_to_TG() uses HTML parsing, so the characters
+Messages are rendered to HTML once by render_message(), so the characters
 "<", ">", and "&" will be replaced.
 """
 
-import os, discord, logging, json, re
-from dotenv import load_dotenv
+import asyncio, copy, discord, time
+from collections import OrderedDict
+from types import MappingProxyType
 from telegram import Bot
-from telegram.error import Forbidden
-from pandas import read_pickle
-from helpers import return_pretty, log, iter_to_str, write_to_pickle
-load_dotenv()
+from helpers import return_pretty, iter_to_str
+from logs import get_logger
+from persistence import UserDatabase
+from dispatcher import Dispatcher
+from outbox import Outbox
+from sender import ProcessBot
+from message_formatter import format_message
+from config import get_config
+from guild_cache import GuildCache
+from digest import DigestBuffer, split_digest
+from matching import EMPTY_SUBSCRIPTIONS, MessageInfo, Subscriptions, match_message, patch_sets
+import metrics
+
+logger = get_logger("discord")
+# Attributes refresh_data() replaces by their rebuilt versions
+LOOKUPS = (
+    "users", "user_triggers", "channel_whitelist", "channel_subscribers", "unrestricted_users",
+    "verified_users", "digest_minutes", "trigger_index", "subscriptions", "stale_keys", "stale_sets",
+)
+# Per-message events, sampled in production via LOG_SAMPLE_RATES
+message_logger = get_logger("discord.messages")
 
 
 class DiscordBot:
     """A class to encapsulate all relevant methods of the Discord bot."""
 
-    def __init__(self, debug_mode=False):
+    def __init__(self):
         """Constructor of the class. Initializes some instance variables."""
 
         # Instantiate Telegram bot to send out messages to users
-        TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+        TELEGRAM_TOKEN = get_config().telegram_bot_token
         self.telegram_bot = Bot(TELEGRAM_TOKEN)
-        # Sets of Discord usernames & roles that trigger Telegram notifications
-        self.listening_to = {"handles": set(), "roles": set()}
-        # Reverse lookup {"handles": {discord username: {telegram id, telegram id}}
-        self.discord_telegram_map = {"handles": {}, "roles": {}}
-        # Dict to store whitelisted channels per TG_id if user has specified any
+        # Rate-limited worker pool doing the actual sending (started in run_bot),
+        # journaling notifications to disk so none get lost on a crash or restart
+        self.outbox_path = "./outbox.sqlite"
+        # SENDER_PROCESSES > 0: HTTP requests to Telegram run in worker processes
+        n_processes = get_config().sender_processes
+        self.sender = ProcessBot(TELEGRAM_TOKEN, processes=n_processes) if n_processes else None
+        # Users who blocked the bot, removed in one batch every blocked_flush_interval seconds
+        self.blocked_users = set()
+        self.blocked_flush_interval = 5
+        self.blocked_user_task = None
+        self.dispatcher = Dispatcher(
+            self.sender or self.telegram_bot,
+            on_forbidden=self.remove_blocked_user,
+            outbox=Outbox(self.outbox_path)
+        )
+        # Users in digest mode {telegram id: minutes} & their buffered notifications, journaled
+        # in the outbox & checked for closed digest windows every digest_flush_interval seconds
+        self.digest_minutes = {}
+        self.digests = DigestBuffer(journal=self.dispatcher.outbox)
+        self.digests.restore()
+        self.digest_flush_interval = 10
+        self.digest_task = None
+        # Forward lookup {telegram id: {"handles": {discord username: index key}, "roles": {role name: index key}}}
+        # The index key a trigger was linked under, so it can be unlinked after a rename
+        self.user_triggers = {}
+        # Dict to store whitelisted channel ids per TG_id if user has specified any
         self.channel_whitelist = {}
-        # Switch on logging of bot data & callback data (inline button presses) for debugging
-        self.debug_mode = debug_mode
+        # Reverse lookup {channel id: {telegram id, ...}} & users without whitelist
+        self.channel_subscribers = {}
+        self.unrestricted_users = set()
+        # Users with a verified Discord account, only they get mention notifications
+        self.verified_users = set()
+        # Inverted index {"handles": {(guild id, member id): {telegram id, ...}}, "roles": ...}
+        self.trigger_index = {"handles": {}, "roles": {}}
+        # The lookups above are only written to. on_message reads an immutable snapshot
+        # of them, republished by reference swap after changes (see get_subscriptions)
+        self.subscriptions = EMPTY_SUBSCRIPTIONS
+        # Changed since the last publish: index keys & channel ids, names of the plain sets
+        self.stale_keys = {"handles": set(), "roles": set(), "channels": set()}
+        self.stale_sets = set()
+        # Telegram ids changed while refresh_data() rebuilds (None: no rebuild running)
+        self.rebuilding = None
         # Dictionary {telegram id: {data}}
         self.users = dict()
-        # Path to shared database (data entry via telegram_bot.py)
-        self.data_path = "./data"
+        # Rendered HTML of recently forwarded messages {message id: html}
+        self.rendered_messages = OrderedDict()
+        self.rendered_cache_size = 256
+        # Channel names, role names & members per guild for the Telegram menus
+        self.guild_cache = GuildCache()
+        # Shared SQLite database (data entry via telegram_bot.py)
+        self.data_path = "./data.sqlite"
+        self.db = UserDatabase(self.data_path)
         self.client = None
+        # Reference point for the time-to-ready log (main.py sets it to process start)
+        self.started_at = time.perf_counter()
 
+        # Sizes of the lookups, read whenever the metrics get scraped
+        sizes = {
+            "users": lambda: len(self.users),
+            "handles": lambda: len(self.trigger_index["handles"]),
+            "roles": lambda: len(self.trigger_index["roles"]),
+            "channels": lambda: len(self.channel_subscribers),
+        }
+        for index, size in sizes.items():
+            metrics.INDEX_SIZE.labels(index).set_function(size)
+        metrics.DIGEST_PENDING.set_function(lambda: len(self.digests))
 
-    async def refresh_data(self) -> None:
-        """Updates from pickle: users, listening_to, discord_telegram_map, channel_whitelist."""
 
-        # Reload database from file. Skip all if no file created yet.
-        try:
-            self.users = read_pickle(self.data_path)["user_data"]
-        except FileNotFoundError:
-            return    # Pickle file will be created automatically
+    async def refresh_data(self) -> None:
+        """
+        Full rebuild from database: users, user_triggers, channel_whitelist,
+        channel_subscribers, trigger_index. Only needed at startup or as a
+        consistency check, settings changes are applied with update_user() & co.
+        Channel names of old whitelists get migrated to ids. The rebuild runs on
+        a copy in a worker thread, messages keep being matched against the
+        current lookups until the new ones are swapped in at once.
+        """
 
-        # Wipe listening_to, discord_telegram_map, channel_whitelist
-        self.listening_to = {"handles": set(), "roles": set()}
-        self.discord_telegram_map = {"handles": {}, "roles": {}}
-        self.channel_whitelist = {}
+        started = time.perf_counter()
 
-        # Repopulate sets of notification triggers and reverse lookups
-        for k, v in self.users.items():
-            TG_id = k
-
-            # Add Discord handles to set of notification triggers
-            if "discord handle" in v:
-                handle = v["discord handle"]
-                self.listening_to["handles"].add(handle)
-                # Add Discord handle to reverse lookup
-                if handle not in self.discord_telegram_map["handles"]:
-                    self.discord_telegram_map["handles"][handle] = set()
-                self.discord_telegram_map["handles"][handle].add(TG_id)
+        # Users changed during the rebuild are applied to it again (the database lags behind)
+        self.rebuilding = set()
+        rebuilt = copy.copy(self)
+        try:
+            await asyncio.to_thread(rebuilt.rebuild_lookups)
+        finally:
+            changed, self.rebuilding = self.rebuilding, None
 
-            # Add Discord roles to set of notification triggers & reverse lookup
-            if "discord roles" in v:
-                roles = v["discord roles"]
+        for TG_id in changed:
+            if TG_id in self.users:
+                rebuilt.update_user(TG_id, self.users[TG_id])
+            else:
+                rebuilt.remove_user(TG_id)
 
-                # Possibility: Only one role set up -> Add it to dicts
-                if isinstance(roles, str):
-                    role = roles
+        # Swap in the rebuilt lookups in one go (no awaits in between)
+        for name in LOOKUPS:
+            setattr(self, name, getattr(rebuilt, name))
 
-                    if role not in self.discord_telegram_map["roles"]:
-                        self.discord_telegram_map["roles"][role] = set()
+        metrics.REFRESH_SECONDS.observe(time.perf_counter() - started)
 
-                    self.discord_telegram_map["roles"][role].add(TG_id)
-                    self.listening_to["roles"].add(role)
 
-                # Possibility: Multiple roles set up -> Add all to dicts
-                else:
-                    for role in roles:
+    def rebuild_lookups(self) -> None:
+        """
+        Worker thread part of refresh_data(), called on a copy of the bot:
+        Fills fresh lookups from the database & builds their snapshot. The copy
+        gets a connection & guild cache of its own, nothing is shared with the
+        event loop but read access to the Discord client.
+        """
+        self.users = dict()
+        self.user_triggers = {}
+        self.channel_whitelist = {}
+        self.channel_subscribers = {}
+        self.unrestricted_users = set()
+        self.verified_users = set()
+        self.digest_minutes = {}
+        self.trigger_index = {"handles": {}, "roles": {}}
+        self.stale_keys = {"handles": set(), "roles": set(), "channels": set()}
+        self.stale_sets = set()
+        self.blocked_users = set(self.blocked_users)
+        self.guild_cache = GuildCache()
+        self.rebuilding = None
+        self.db = UserDatabase(self.data_path)
 
-                        if role not in self.discord_telegram_map["roles"]:
-                            self.discord_telegram_map["roles"][role] = set()
+        # Repopulate sets of notification triggers and reverse lookups
+        try:
+            for TG_id, user_data in self.db.load_users().items():
+                if self.migrate_channels(user_data):
+                    self.db.save_user(TG_id, user_data)
+                self.update_user(TG_id, user_data)
+        finally:
+            self.db.close()
+
+        self.subscriptions = Subscriptions.build(
+            self.users, self.verified_users, self.trigger_index,
+            self.channel_subscribers, self.unrestricted_users
+        )
+        self.stale_keys = {"handles": set(), "roles": set(), "channels": set()}
+        self.stale_sets = set()
+
+
+    def reindex(self) -> None:
+        """
+        Resolves the index keys of all known users again from the data in
+        memory, i.e. once the Discord client is (re)connected & role names or
+        handles without a stored Discord id can be looked up. Unlike
+        refresh_data() it doesn't reload the database, which lags behind the
+        settings relayed with update_user() until the next persistence flush.
+        """
+        for TG_id, user_data in self.users.items():
+            for category, triggers in self.user_triggers.get(TG_id, {}).items():
+                for trigger in list(triggers):
+                    self.unlink_trigger(TG_id, category, trigger)
+                    self.link_trigger(TG_id, category, trigger)
+
+            # Old whitelists loaded before the client was connected still hold channel names
+            if self.migrate_channels(user_data):
+                self.db.save_user(TG_id, user_data)
+                self.set_whitelist(TG_id, user_data["discord channels"])
+
+
+    @staticmethod
+    def get_user_triggers(user_data) -> dict:
+        """Returns {"handles": {handle}, "roles": {roles}} as stored in a user's data."""
+        roles = user_data.get("discord roles", set())
+        # Possibility: Only one role set up (stored as str)
+        if isinstance(roles, str):
+            roles = {roles}
+        handles = {user_data["discord handle"]} if "discord handle" in user_data else set()
+        return {"handles": handles, "roles": set(roles)}
+
+
+    def get_index_key(self, TG_id, category, trigger) -> tuple:
+        """
+        Returns the trigger_index key (guild id, member/role id) of a trigger
+        or None if it can't be resolved (yet). Role names and handles without
+        a stored Discord id can only be resolved once the Discord client is
+        connected, so they get resolved again by reindex() from on_ready.
+        """
+        user_data = self.users[TG_id]
+        guild_id = user_data.get("discord guild")
+        guild = self.client.get_guild(guild_id) if self.client and guild_id else None
+
+        # Discord handle -> member id (stored at handle entry, else look up by name)
+        if category == "handles":
+            member_id = user_data.get("discord id")
+            if member_id is None and guild:
+                member = self.guild_cache.get_member_named(guild, trigger)
+                member_id = member.id if member else None
+            return (guild_id, int(member_id)) if member_id is not None else None
+
+        # Discord role name -> role id (@everyone has the guild id as role id)
+        role = discord.utils.get(guild.roles, name=trigger) if guild else None
+        return (guild_id, role.id) if role else None
+
+
+    def link_trigger(self, TG_id, category, trigger) -> None:
+        """Adds one trigger of a known user to user_triggers & the index."""
+        key = self.get_index_key(TG_id, category, trigger)
+        self.user_triggers.setdefault(TG_id, {"handles": {}, "roles": {}})[category][trigger] = key
+        if key:
+            self.trigger_index[category].setdefault(key, set()).add(TG_id)
+            self.stale_keys[category].add(key)
+
+
+    def unlink_trigger(self, TG_id, category, trigger) -> None:
+        """Removes one trigger of a known user from all lookups. Drops empty entries."""
+        # Key it was linked under, the role may have been renamed since
+        key = self.user_triggers.get(TG_id, {}).get(category, {}).pop(trigger, None)
+        if key is None:
+            return
+
+        id_set = self.trigger_index[category].get(key, set())
+        id_set.discard(TG_id)
+        if not id_set:
+            self.trigger_index[category].pop(key, None)
+        self.stale_keys[category].add(key)
+
+
+    def update_user(self, TG_id, user_data) -> None:
+        """
+        Applies the current data of one Telegram user to all lookups.
+        Only the differences to the previously known data get (un)linked.
+        """
+        if self.rebuilding is not None:
+            self.rebuilding.add(TG_id)
+        old = self.users.get(TG_id)
+
+        # Users who wiped their data are dropped entirely
+        if not user_data:
+            self.remove_user(TG_id)
+            return
+
+        # Possibility: User unblocked the bot again before being removed
+        self.blocked_users.discard(TG_id)
+
+        # Old whitelists hold channel names, fixed in the Telegram bot's user_data too
+        self.migrate_channels(user_data)
+
+        # Copy sets, the Telegram bot keeps mutating its own user_data
+        new = {k: set(v) if isinstance(v, set) else v for k, v in user_data.items()}
+
+        # Possibility: New user or guild/handle/Discord id changed -> Relink everything
+        identity = ("discord guild", "discord handle", "discord id")
+        if old is None or any(old.get(k) != new.get(k) for k in identity):
+            self.remove_user(TG_id)
+            self.users[TG_id] = new
+            self.stale_sets.add("users")
+            for category, triggers in self.get_user_triggers(new).items():
+                for trigger in triggers:
+                    self.link_trigger(TG_id, category, trigger)
+
+        # Possibility: Known user -> Only (un)link the roles that changed
+        else:
+            old_roles = self.get_user_triggers(old)["roles"]
+            new_roles = self.get_user_triggers(new)["roles"]
+            for role in old_roles - new_roles:
+                self.unlink_trigger(TG_id, "roles", role)
+            self.users[TG_id] = new
+            for role in new_roles - old_roles:
+                self.link_trigger(TG_id, "roles", role)
+
+        self.set_whitelist(TG_id, new.get("discord channels", set()))
+
+        if new.get("verified discord"):
+            self.verified_users.add(TG_id)
+        else:
+            self.verified_users.discard(TG_id)
+        self.stale_sets.add("verified")
+
+        # Possibility: Switched back to immediate delivery -> Send what's buffered with the next check
+        if new.get("digest minutes"):
+            self.digest_minutes[TG_id] = new["digest minutes"]
+        elif self.digest_minutes.pop(TG_id, None):
+            self.digests.release(TG_id)
+
+
+    def remove_user(self, TG_id) -> None:
+        """Removes a Telegram user & all their triggers from all lookups."""
+        if TG_id not in self.users:
+            return
+        if self.rebuilding is not None:
+            self.rebuilding.add(TG_id)
+
+        for category, triggers in self.user_triggers.get(TG_id, {}).items():
+            for trigger in list(triggers):
+                self.unlink_trigger(TG_id, category, trigger)
+
+        self.set_whitelist(TG_id, None)
+        self.verified_users.discard(TG_id)
+        self.digest_minutes.pop(TG_id, None)
+        self.digests.discard(TG_id)
+        self.user_triggers.pop(TG_id, None)
+        del self.users[TG_id]
+        self.stale_sets |= {"users", "verified"}
+
+
+    def remove_trigger(self, TG_id, category, trigger) -> None:
+        """Removes a Discord handle or role (category "handles" / "roles") of a known user."""
+        # Possibility: User was dropped meanwhile (i.e. blocked the bot) -> Nothing to remove
+        if TG_id not in self.users:
+            return
+        if self.rebuilding is not None:
+            self.rebuilding.add(TG_id)
+        self.unlink_trigger(TG_id, category, trigger)
+        if category == "handles":
+            self.users[TG_id].pop("discord handle", None)
+        else:
+            roles = self.get_user_triggers(self.users[TG_id])["roles"]
+            self.users[TG_id]["discord roles"] = roles - {trigger}
+
+
+    def set_whitelist(self, TG_id, channel_ids) -> None:
+        """Replaces the channel whitelist of a user (None: forget user) in both lookups."""
+        old_ids = self.channel_whitelist.pop(TG_id, set())
+        for channel_id in old_ids:
+            id_set = self.channel_subscribers.get(channel_id, set())
+            id_set.discard(TG_id)
+            if not id_set:
+                self.channel_subscribers.pop(channel_id, None)
+        self.unrestricted_users.discard(TG_id)
+        self.stale_keys["channels"] |= old_ids
+        self.stale_sets.add("unrestricted")
+
+        if channel_ids is None:
+            return
+
+        self.channel_whitelist[TG_id] = set(channel_ids)
+        for channel_id in channel_ids:
+            self.channel_subscribers.setdefault(channel_id, set()).add(TG_id)
+        self.stale_keys["channels"] |= self.channel_whitelist[TG_id]
+        if not channel_ids:
+            self.unrestricted_users.add(TG_id)
+
+
+    def migrate_channels(self, user_data) -> bool:
+        """
+        Replaces channel names in a user's whitelist with channel ids, in place.
+        Names of channels that no longer exist are dropped. Returns True if
+        anything changed. Needs the Discord client to be connected.
+        """
+        channels = user_data.get("discord channels")
+        if not channels or not any(isinstance(c, str) for c in channels):
+            return False
 
-                        self.discord_telegram_map["roles"][role].add(TG_id)
+        guild = self.client.get_guild(user_data.get("discord guild")) if self.client else None
+        if not guild:
+            return False
 
-                    self.listening_to["roles"].update(roles)
+        migrated = set()
+        for channel in channels:
+            if isinstance(channel, str):
+                found = discord.utils.get(guild.channels, name=channel)
+                if not found:
+                    logger.info("Dropped whitelisted channel %r, not found on %s", channel, guild.name)
+                    continue
+                channel = found.id
+            migrated.add(channel)
 
-            # Add Discord channels to channel whitelist
-            if "discord channels" in v:
-                self.channel_whitelist[k] = v["discord channels"]
+        user_data["discord channels"] = migrated
+        return True
 
 
-    async def send_to_TG(self, telegram_user_id, content, header="", guild=None, parse_mode='HTML') -> None:
+    def render_message(self, message) -> str:
         """
-        Sends a message a specific Telegram user id. Does some replacing & escaping.
-        Adds header to msg. Defaults to HTML parsing.
+        Returns the HTML body forwarded to Telegram for a Discord message.
+        Rendered once per message id, every recipient gets the cached text.
         """
+        cache = self.rendered_messages
 
-        def add_html_hyperlinks(_str):
-            """Adds html hyperlink tags around any url starting with http or https."""
-            url_pattern = re.compile(r"""((https://|http://)[^ <>'"{}|\\^`[\]]*)""")
-            return url_pattern.sub(r"<a href='\1'>\1</a>", _str)
-
-        def resolve_usernames(_str, guild):
-            """Replaces mentions of user ids with their actual nicks/names."""
-
-            user_mention = r"<@[0-9]+>"
-            user_ids = re.findall(user_mention, _str)
-
-            # Replace each user id with a nickname or username
-            for id_match in user_ids:
-                id_int = int(id_match.strip('<>@'))
-                member = guild.get_member(id_int)
-                name = member.name
-                if member.nick: name = member.nick
-                _str = _str.replace(id_match, str("🌀<i>"+name+"</i>"))
-
-            return _str
-
-        def resolve_role_names(_str, guild):
-            """Replaces mentions of user ids with their actual nicks/names."""
-
-            role_mention = r"<@&[0-9]+>"
-            role_ids = re.findall(role_mention, _str)
-
-            # Replace each role id with its name
-            for id_match in role_ids:
-                id_int = int(id_match.strip('<>@&'))
-                role = guild.get_role(id_int)
-                name = role.name
-                _str = _str.replace(id_match, str("🌀<i>"+name+"</i>"))
-
-            return _str
-
-        def resolve_channels(_str, guild):
-            """Replaces mentions of user ids with their actual nicks/names."""
-
-            channel_mention = r"&lt;#[0-9]+&gt;"
-            channel_ids = re.findall(channel_mention, _str)
-
-            # Wrap a hyperlink around each channel id
-            for id_match in channel_ids:
-                id_int = int(id_match.strip('&lgt;#'))
-                channel = guild.get_channel_or_thread(id_int)
-                name = channel.name
-                url = channel.jump_url
-                _str = _str.replace(id_match, f"<a href='{url}'>{name}</a>")
-
-            return _str
-
-        def escape_chars(_str):
-            """
-            Replaces the HTML special character "&".
-            Replace "<", ">", "&" if not within HTML tags <b>, <i> and <a>.
-            """
-            # Replace "&" with "&amp;" everywhere
-            _str = re.sub("&", "&amp;", _str)
-
-            # Replace "<" with "&lt;" if not followed by "b>", "i>", "/", or "a"
-            lt_not_part_of_tag = "<(?!(b>|i>|u>|/|a))" # negative lookahead
-            _str = re.sub(lt_not_part_of_tag, "&lt;", _str)
-
-            # Replace ">" with "&gt;" if not preceded by "b", "i", "a", or "'"
-            gt_not_part_of_tag = "(?<!(b|i|a|u|'))>" # negative lookbehind
-            _str = re.sub(gt_not_part_of_tag, "&gt;", _str)
-
-            return _str
-
-        # Execute replacements (order matters to avoid double hyperlinking)
-
-        # Replace mentioned user ids with usernames
-        content = resolve_usernames(content, guild)
-        # Replace mentioned role ids with role names
-        content = resolve_role_names(content, guild)
-        # Replace special chars with their escape seqences
-        content = escape_chars(content)
-        # Convert urls in content to hyperlinks & concatenate msg back together
-        content = add_html_hyperlinks(content)
-        # Add hyperlinks around mentioned channels
-        content = resolve_channels(content, guild)
+        if message.id in cache:
+            cache.move_to_end(message.id)
+            return cache[message.id]
 
-        parsed_msg = header+content
+        content = self.render_content(message.content, message.guild)
+        cache[message.id] = content
 
-        # Send to user unless they deleted (=blocked) the chat with the bot.
-        try:
-            await self.telegram_bot.send_message(
-                chat_id=telegram_user_id,
-                text=parsed_msg,
-                disable_web_page_preview=True,
-                parse_mode=parse_mode
-                )
+        # Only the most recent messages are needed -> Evict the oldest ones
+        if len(cache) > self.rendered_cache_size:
+            cache.popitem(last=False)
 
-            if self.debug_mode:
-                log(f"FORWARDED A MESSAGE!")
+        return content
 
-        # If blocked by user -> Delete from database (no more announcements for them).
-        except Forbidden:
 
-            log(f"Blocked by user {telegram_user_id}. Didn't forward.")
+    def render_content(self, content, guild) -> str:
+        """Resolves mentions, escapes HTML special chars & adds hyperlinks."""
+        return format_message(content, guild)
 
-            data = read_pickle(self.data_path)
 
-            if int(telegram_user_id) in data["user_data"]:
+    async def send_to_TG(
+        self, telegram_user_id, content, header="", parse_mode='HTML', created_at=None
+    ) -> None:
+        """
+        Sends a message a specific Telegram user id. Expects content already
+        rendered by render_message(). Adds header to msg. Defaults to HTML parsing.
+        created_at (unix time of the Discord message) is used for delay metrics.
+        """
 
-                del data["user_data"][int(telegram_user_id)]
-                write_to_pickle(data, self.data_path)
-                log(f"Deleted user {telegram_user_id} from database.")
+        # Possibility: User blocked the bot & awaits removal -> Don't waste an API call
+        if telegram_user_id in self.blocked_users:
+            return
 
-                await self.refresh_data()
+        parsed_msg = header+content
 
+        # Queue for sending. Blocked users are handled by remove_blocked_user().
+        await self.dispatcher.submit(
+            telegram_user_id,
+            parsed_msg,
+            created_at=created_at,
+            disable_web_page_preview=True,
+            parse_mode=parse_mode
+            )
 
-    async def send_to_all(self, content, **kwargs) -> None:
-        """Sends a message to all Telegram bot users except if they wiped their data."""
-        TG_ids = [k for k, v in self.users.items() if v != {}]
+        message_logger.debug("Queued a message", extra={"chat_id": telegram_user_id})
 
-        for _id in TG_ids:
 
-            await self.send_to_TG(_id, content, **kwargs)
+    async def remove_blocked_user(self, telegram_user_id) -> None:
+        """
+        Marks a user who deleted (=blocked) the chat with the bot for removal.
+        A broadcast can hit hundreds of those, so they are deleted in one batch
+        by flush_blocked_users().
+        """
+        logger.debug("Blocked by user, didn't forward", extra={"chat_id": telegram_user_id})
+        self.blocked_users.add(int(telegram_user_id))
+
+
+    def flush_blocked_users(self) -> None:
+        """Deletes all users marked by remove_blocked_user() in one transaction."""
+        if not self.blocked_users:
+            return
+
+        # Only unmark after the write went through, a failed one is retried next time
+        blocked = set(self.blocked_users)
+        deleted = self.db.delete_users(blocked)
+        self.blocked_users -= blocked
+        for TG_id in blocked:
+            self.remove_user(TG_id)
+
+        logger.info("Blocked by %d users, deleted %d of them from database", len(blocked), deleted)
+
+
+    async def flush_digests(self, everything=False) -> None:
+        """Sends the digests of all closed windows (everything: of all windows)."""
+        for TG_id, entries in self.digests.take_due(everything).items():
+            title = f"📬 <b>{len(entries)} notification{'s' if len(entries) > 1 else ''}</b>"
+            for text in split_digest(entries, title):
+                metrics.DIGEST_MESSAGES.inc()
+                # Delay metrics count from now, the wait for the window is on purpose
+                await self.send_to_TG(TG_id, text)
+            # Queued (or dropped for a blocked user) -> No need to restore it after a crash anymore
+            self.digests.sent(TG_id)
+
+
+    async def digest_flusher(self) -> None:
+        """Calls flush_digests() every digest_flush_interval seconds."""
+        while True:
+            await asyncio.sleep(self.digest_flush_interval)
+            try:
+                await self.flush_digests()
+            except Exception as e:
+                logger.error("Could not send digests: %r", e)
+
+
+    async def blocked_user_flusher(self) -> None:
+        """Calls flush_blocked_users() every blocked_flush_interval seconds."""
+        while True:
+            await asyncio.sleep(self.blocked_flush_interval)
+            try:
+                self.flush_blocked_users()
+            except Exception as e:
+                logger.error("Could not delete blocking users: %r", e)
+
+
+    def publish_subscriptions(self) -> None:
+        """
+        Replaces the published snapshot by one with all changes since the last
+        publish. Copy-on-write: Only changed sets are frozen again, unchanged
+        ones are shared with the previous snapshot. Each changed mapping still
+        gets a shallow copy (see patch_sets), i.e. O(index size) per publish.
+        Publishes are lazy & batched by get_subscriptions(), so that's paid at
+        most once per Discord message.
+        """
+        old, keys, sets = self.subscriptions, self.stale_keys, self.stale_sets
+        self.stale_keys = {"handles": set(), "roles": set(), "channels": set()}
+        self.stale_sets = set()
+
+        trigger_index = {
+            category: patch_sets(old.trigger_index[category], self.trigger_index[category], keys[category])
+            if keys[category] else old.trigger_index[category]
+            for category in ("handles", "roles")
+        }
+        channel_subscribers = old.channel_subscribers
+        if keys["channels"]:
+            channel_subscribers = patch_sets(channel_subscribers, self.channel_subscribers, keys["channels"])
+
+        # Single reference swap, readers see either all or none of the changes
+        self.subscriptions = Subscriptions(
+            users=frozenset(self.users) if "users" in sets else old.users,
+            verified=frozenset(self.verified_users) if "verified" in sets else old.verified,
+            trigger_index=MappingProxyType(trigger_index),
+            channel_subscribers=channel_subscribers,
+            unrestricted_users=frozenset(self.unrestricted_users) if "unrestricted" in sets else old.unrestricted_users
+        )
+
+
+    def get_subscriptions(self) -> Subscriptions:
+        """Returns the current immutable snapshot read by the matching engine (see matching.py)."""
+        if self.stale_sets or any(self.stale_keys.values()):
+            self.publish_subscriptions()
+        return self.subscriptions
 
 
     async def get_guild(self, guild_id) -> discord.Guild:
@@ -242,7 +571,7 @@ class DiscordBot:
     async def get_user(self, guild_id, username) -> discord.User:
         """Takes guild id & username, returns user object or None if not found."""
         guild = await self.get_guild(guild_id)
-        return guild.get_member_named(username)
+        return self.guild_cache.get_member_named(guild, username)
 
 
     async def get_user_id(self, guild_id, username) -> str:
@@ -254,43 +583,39 @@ class DiscordBot:
     async def get_guild_roles(self, guild_id) -> list:
         """Takes guild id returns list of names of all roles on guild."""
         guild = await self.get_guild(guild_id)
-        return [x.name for x in guild.roles]
+        return self.guild_cache.get_roles(guild)
 
 
     async def get_user_roles(self, discord_username, guild_id) -> list:
         """Takes a Discord username, returns all user's role names in current guild."""
         guild = await self.get_guild(guild_id)
-        user = guild.get_member_named(discord_username)
+        user = self.guild_cache.get_member_named(guild, discord_username)
         roles = [role.name for role in user.roles]
         return roles
 
 
-    async def get_channels(self, guild_id) -> list:
-        """Takes a guild ID, returns subset of text channel names of this guild."""
-
-        out_channels = []
+    async def get_channels(self, guild_id) -> dict:
+        """Takes a guild ID, returns {channel name: channel id} for a subset of text channels."""
         guild = await self.get_guild(guild_id)
-        channels = guild.channels
-
-        # Only show channels from welcome, community & contribute categories
-        allowed_channel_categories = json.loads(os.getenv("ALLOWED_CHANNEL_CATEGORIES"))
+        # Only channels from welcome, community & contribute categories, see GuildCache
+        return self.guild_cache.get_channels(guild)
 
-        # Filter out anything but text channels + anything specified here:
-        filter_out = ["ticket", "closed"]
-        for channel in channels:
-            if "text" in channel.type and not any(x in channel.name for x in filter_out):
-                if channel.category_id in allowed_channel_categories:
-                    out_channels.append(channel.name)
 
-        return out_channels
+    async def get_channel_names(self, guild_id, channel_ids) -> dict:
+        """Takes a guild ID & channel ids, returns {channel name: channel id} for display."""
+        guild = await self.get_guild(guild_id)
+        names = {}
+        for channel_id in channel_ids:
+            channel = guild.get_channel(channel_id) if guild and isinstance(channel_id, int) else None
+            # Possibility: Deleted channel or name not migrated yet -> Show as is
+            names[channel.name if channel else str(channel_id)] = channel_id
+        return names
 
 
     def get_listening_to(self, TG_id) -> dict:
         """Takes a TG username, returns whatever this user gets notifications for currently."""
-        _map = self.discord_telegram_map
-        handles_active = {k for k, v in _map["handles"].items() if TG_id in v}
-        roles_active = {k for k, v in _map["roles"].items() if TG_id in v}
-        return {"handles": handles_active, "roles": roles_active}
+        triggers = self.user_triggers.get(TG_id, {})
+        return {category: set(triggers.get(category, ())) for category in ("handles", "roles")}
 
 
     async def get_active_notifications(self, TG_id) -> dict:
@@ -299,16 +624,50 @@ class DiscordBot:
         for all Discord triggers the bot is currently listening to for this
         Telegram user.
         """
-        lookup = self.discord_telegram_map
+        # Forward lookup, only touches this user's own triggers
+        return self.get_listening_to(TG_id)
+
+
+    async def handle_message(self, message) -> None:
+        """Forwards a new Discord message to everyone who should be notified about it."""
 
-        d = {category: set() for category in lookup}
+        metrics.DISCORD_MESSAGES.inc()
 
-        # Add all triggers containing this Telegram id to their respective category in d
-        for category, trigger_dict in lookup.items():
-            for trigger, id_set in trigger_dict.items():
-                if TG_id in id_set:
-                    d[category].add(trigger)
-        return d
+        # Possibility: Direct message to the bot -> No guild, nothing to forward
+        if message.guild is None:
+            return
+
+        info = MessageInfo.from_message(message)
+
+        if info.mentions or info.role_mentions:
+            message_logger.debug(
+                "%d mentions in %s", len(info.mentions) + len(info.role_mentions), info.channel_name
+            )
+
+        # Collect who gets notified & why before sending anything, so one
+        # message mentioning a user & their roles only sends one notification
+        notifications = match_message(
+            self.get_subscriptions(), info, get_config().always_active_channels
+        )
+        metrics.MESSAGE_MATCHES.observe(len(notifications))
+
+        if not notifications:
+            return
+
+        content = self.render_message(message)
+
+        for notification in notifications:
+
+            # Possibility: User gets digests -> Buffer until their window closes
+            minutes = self.digest_minutes.get(notification.recipient)
+            if minutes:
+                self.digests.add(notification.recipient, notification.header + content, minutes)
+                metrics.DIGEST_NOTIFICATIONS.inc()
+                continue
+
+            await self.send_to_TG(
+                notification.recipient, content, header=notification.header, created_at=info.created_at
+            )
 
 
     async def run_bot(self) -> None:
@@ -317,6 +676,13 @@ class DiscordBot:
         # Update data to listen to at startup
         await self.refresh_data()
 
+        # Start workers sending out Telegram messages
+        if self.sender:
+            self.sender.start()
+        await self.dispatcher.start()
+        self.blocked_user_task = asyncio.create_task(self.blocked_user_flusher())
+        self.digest_task = asyncio.create_task(self.digest_flusher())
+
         # Fire up discord client
         intents = discord.Intents.default()
         intents.members = True
@@ -328,187 +694,75 @@ class DiscordBot:
         @client.event
         async def on_ready():
 
-            log(f"{client.user.name} has connected to Discord")
-
-        # Actions taken for every new Discord message
-        @client.event
-        async def on_message(message):
-
-            # If message in non-deactivatable channel -> Forward to everyone known to TG bot
-            always_active_channels = json.loads(os.getenv("ALWAYS_ACTIVE_CHANNELS"))
-            always_active_channels = [int(x) for x in always_active_channels]
-            guild = message.guild
-            channel_id = message.channel.id
-
-            if channel_id in always_active_channels:
-                channel = message.channel.name
-
-                if self.debug_mode:
-                    log(f"MSG IN ALWAYS ACTIVE CHANNEL ({channel}). SENT TO EVERYONE.")
-
-                content = message.content
-                url = message.jump_url
-                author = message.author.name
-
-                header = f"\n🌀<i>{author}</i> posted in <a href='{url}'>{channel}</a>:\n\n"
-
-                await self.send_to_all(
-                    content,
-                    header=header,
-                    guild=guild
-                )
-
-                return    # -> Skip every other case
-
-
-            # If no user mentions in message -> Skip this part
-            if message.mentions != []:
-
-                if self.debug_mode: log(f"{len(message.mentions)} USER MENTIONS IN {message.channel.name}.")
-
-                channel = message.channel.name
-                whitelist = self.channel_whitelist
-
-                # User mentions: Forward to TG as specified in lookup dict
-                for username in self.listening_to["handles"]:
-                    user = message.guild.get_member_named(username)
-
-                    # Cycle through all user mentions in message
-                    if user in message.mentions:
-
-                        if self.debug_mode: log(f"USER IN MENTIONS: {username} mentioned.")
-
-                        msg_author, guild, channel = message.author, message.guild, message.channel.name
-                        alias, url = user.display_name, message.jump_url
-                        content = message.content
-                        author = msg_author.name
-                        if msg_author.nick: author = msg_author.nick
-                        header = f"\nMentioned by 🌀<i>{author}</i> in <a href='{url}'>{channel}</a>:\n\n"
-
-                        # Cycle through all TG ids connected to this Discord handle
-                        for _id in self.discord_telegram_map["handles"][username]:
-
-                            target_guild_id = self.users[_id]["discord guild"]
-
-                            if self.debug_mode:
-                                log(
-                                    f"GUILD CHECK: {type(guild.id)} {guild.id} =="
-                                    f" {type(target_guild_id)} {target_guild_id}:"
-                                    f" {guild.id == target_guild_id}"
-                                )
-
-                            # Condition 1: User Discord is verified
-                            if self.users[_id]["verified discord"]:
-
-                                # Condition 2: msg guild matches guild set up by user
-                                if guild.id == target_guild_id:
-
-                                    if self.debug_mode:
-                                        log(
-                                            f"CHANNEL CHECK: {channel} in whitelist:"
-                                            f" {channel in whitelist[_id]}\n"
-                                            f"SET UP CHANNELS: {whitelist[_id]}"
-                                        )
-
-                                    # Condition 3: Channel matches or no channels set up
-                                    if whitelist[_id] == set():
-
-                                        await self.send_to_TG(
-                                            _id,
-                                            content,
-                                            header=header,
-                                            guild=guild
-                                        )
-
-                                    else:
-
-                                        if channel in whitelist[_id]:
+            time_to_ready = time.perf_counter() - self.started_at
+            logger.info(
+                "%s has connected to Discord (%.2fs after start)", client.user.name, time_to_ready,
+                extra={"time_to_ready": round(time_to_ready, 3)}
+            )
 
-                                            await self.send_to_TG(
-                                                _id,
-                                                content,
-                                                header=header,
-                                                guild=guild
-                                            )
-
-                            else:
-                                if self.debug_mode: log(f"UNVERIFIED DISCORD: {_id}. NO HANDLE NOTIFICATION SENT.")
-
-
-            # If no role mentions in message -> Skip this part
-            if message.role_mentions != [] or message.mention_everyone:
-
-                if self.debug_mode: log(f"ROLE MENTIONS IN MESSAGE: {message.role_mentions}")
-
-                channel = message.channel.name
-                whitelist = self.channel_whitelist
-                rolenames = [x.name for x in message.role_mentions]
-
-                # Add in mention of @everyone as role mention
-                if message.mention_everyone:
-                    rolenames.append('@everyone')
-
-                # Role mentions: Forward to TG as specified in lookup dict
-                for role in self.listening_to["roles"]:
-
-                    if role in rolenames:
-
-                        if self.debug_mode: log(f"MATCHED A ROLE: {role} mentioned.")
-
-                        guild = message.guild
-                        url = message.jump_url
-                        channel = message.channel.name
-                        content = message.content
-                        author = message.author.name
-
-                        header = f"🌀<i>{author}</i> mentioned <i>{role}</i> in <a href='{url}'>{channel}</a>:\n\n"
+            # Guilds are (re)cached now -> resolve role names & handles to ids. Fires again
+            # after every failed RESUME, so don't reload the (possibly stale) database
+            self.guild_cache.clear()
+            self.reindex()
 
+        # Keep the guild metadata of the Telegram menus up to date
+        @client.event
+        async def on_guild_channel_create(channel):
+            self.guild_cache.invalidate(channel.guild.id, "channels")
 
-                        # Cycle through all TG ids connected to this Discord role
-                        for _id in self.discord_telegram_map["roles"][role]:
+        @client.event
+        async def on_guild_channel_delete(channel):
+            self.guild_cache.invalidate(channel.guild.id, "channels")
 
-                            target_guild_id = self.users[_id]["discord guild"]
+        @client.event
+        async def on_guild_channel_update(before, after):
+            self.guild_cache.invalidate(after.guild.id, "channels")
 
-                            if self.debug_mode:
-                                log(
-                                    f"GUILD CHECK: {guild.id} == {target_guild_id}:"
-                                    f" {guild.id == target_guild_id}"
-                                )
+        @client.event
+        async def on_guild_role_create(role):
+            self.guild_cache.invalidate(role.guild.id, "roles")
 
-                            # Condition 1: User Discord is verified
-                            if self.users[_id]["verified discord"]:
+        @client.event
+        async def on_guild_role_delete(role):
+            self.guild_cache.invalidate(role.guild.id, "roles")
 
-                                # Condition 2: msg guild matches guild set up by user
-                                if guild.id == target_guild_id:
-                                    if self.debug_mode:
-                                        log(
-                                            f"CHANNEL CHECK: {type(channel)} {channel} in"
-                                            f" {whitelist[_id]}: {channel in whitelist[_id]}\n"
-                                            f"SET UP CHANNELS: {whitelist[_id]}"
-                                        )
+        @client.event
+        async def on_guild_role_update(before, after):
+            self.guild_cache.invalidate(after.guild.id, "roles")
 
-                                    # Condition 3: Channel matches or no channels set up
-                                    if whitelist[_id] == set():
+        @client.event
+        async def on_member_join(member):
+            self.guild_cache.invalidate(member.guild.id, "members")
 
-                                        await self.send_to_TG(
-                                            _id,
-                                            content,
-                                            header=header,
-                                            guild=guild
-                                        )
+        @client.event
+        async def on_member_remove(member):
+            self.guild_cache.invalidate(member.guild.id, "members")
 
-                                    else:
+        @client.event
+        async def on_member_update(before, after):
+            # Only nickname changes affect the name -> member map
+            if before.nick != after.nick:
+                self.guild_cache.invalidate(after.guild.id, "members")
 
-                                        if channel in whitelist[_id]:
+        @client.event
+        async def on_user_update(before, after):
+            # Username changes affect the name -> member map of every guild
+            if (before.name, before.discriminator) != (after.name, after.discriminator):
+                for guild in after.mutual_guilds:
+                    self.guild_cache.invalidate(guild.id, "members")
 
-                                            await self.send_to_TG(
-                                                _id,
-                                                content,
-                                                header=header,
-                                                guild=guild
-                                            )
-                            else:
-                                if self.debug_mode: log("UNVERIFIED DISCORD. NO ROLE NOTIFICATION SENT.")
+        # Actions taken for every new Discord message
+        @client.event
+        async def on_message(message):
+            started = time.perf_counter()
+            await self.handle_message(message)
+            metrics.ON_MESSAGE_SECONDS.observe(time.perf_counter() - started)
 
-        DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
-        await client.start(DISCORD_TOKEN)
+        DISCORD_TOKEN = get_config().discord_token
+        try:
+            await client.start(DISCORD_TOKEN)
+        finally:
+            # Buffered digests are journaled & go on after a restart, write out the last changes
+            self.dispatcher.outbox.flush()
+            if self.sender:
+                await asyncio.to_thread(self.sender.stop)
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In this file the Dispatcher class is defined. It decouples the Discord bot
+from the Telegram API: messages are put on a bounded queue and sent out by a
+pool of workers which respect Telegram's global and per-chat rate limits.
+With an Outbox, messages are journaled to disk first and fed to the queue
+from there, so a backlog survives restarts and doesn't have to fit in memory.
+"""
+
+import asyncio, random, time
+from collections import deque
+from telegram.error import Forbidden, RetryAfter, NetworkError, TimedOut, TelegramError
+from logs import get_logger
+import metrics
+
+logger = get_logger("dispatcher")
+
+
+class TokenBucket:
+    """Simple token bucket. Refills `rate` tokens per second up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def is_idle(self) -> bool:
+        """True if the bucket is full again, i.e. it can be dropped without effect."""
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self) -> None:
+        """Waits until a token is available, then takes it."""
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Dispatcher:
+    """Bounded worker pool sending queued messages with a Telegram bot."""
+
+    def __init__(
+        self,
+        bot,
+        workers=8,
+        global_rate=30,
+        chat_rate=1,
+        chat_burst=3,
+        max_queue=10000,
+        max_retries=5,
+        on_forbidden=None,
+        report_interval=60,
+        outbox=None,
+        flush_interval=0.1
+    ):
+        """Constructor of the class. Rates are given in messages per second."""
+        self.bot = bot
+        self.n_workers = workers
+        self.max_retries = max_retries
+        # Coroutine function called with the chat id if a user blocked the bot
+        self.on_forbidden = on_forbidden
+        self.report_interval = report_interval
+        # Optional durable journal (see outbox.py), written every flush_interval seconds
+        self.outbox = outbox
+        self.flush_interval = flush_interval
+        if outbox:
+            metrics.OUTBOX_BACKLOG.set_function(lambda: self.outbox.backlog)
+        self.last_loaded = 0
+        self.flushed = None
+        # Telegram allows ~30 msg/s overall and about 1 msg/s per chat
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate, self.chat_burst = chat_rate, chat_burst
+        self.chat_buckets = {}
+        # Queue gets created in start() so it is bound to the running loop
+        self.max_queue = max_queue
+        self.queue = None
+        self.tasks = []
+        # Counters for stats()
+        self.started_at = None
+        self.sent, self.failed, self.retried, self.forbidden = 0, 0, 0, 0
+        self.latencies = deque(maxlen=1000)
+
+
+    async def start(self) -> None:
+        """Spawns the worker tasks. Needs a running event loop."""
+        if self.tasks:
+            return
+        self.started_at = time.monotonic()
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.n_workers)]
+        if self.outbox:
+            self.flushed = asyncio.Event()
+            self.tasks += [asyncio.create_task(self.flusher()), asyncio.create_task(self.feeder())]
+        if self.report_interval:
+            self.tasks.append(asyncio.create_task(self.reporter()))
+
+
+    async def stop(self) -> None:
+        """Waits for the queue to drain, then cancels all workers."""
+        if self.outbox:
+            while self.outbox.backlog:
+                await asyncio.sleep(self.flush_interval)
+        await self.queue.join()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.outbox:
+            self.outbox.flush()
+
+
+    async def submit(self, chat_id, text, created_at=None, **kwargs) -> None:
+        """
+        Queues a message. Only waits if the queue is full (backpressure).
+        Latencies count from created_at (unix time) if given, else from now.
+        """
+        queued_at = created_at or time.time()
+        if not self.outbox:
+            await self.queue.put((None, chat_id, text, kwargs, queued_at))
+            return
+
+        self.outbox.append(chat_id, text, kwargs, queued_at)
+        # Bursts faster than the flusher: Write out now instead of piling up in memory
+        if len(self.outbox.appended) >= self.max_queue:
+            await self.flush_outbox()
+
+
+    async def flush_outbox(self) -> None:
+        """Commits buffered appends & acks of the outbox without blocking the loop."""
+        appended, acked, digest_changes = self.outbox.take()
+        if appended or acked or digest_changes:
+            await asyncio.to_thread(self.outbox.write, appended, acked, digest_changes)
+        if appended:
+            self.flushed.set()
+
+
+    async def flusher(self) -> None:
+        """Commits the outbox every flush_interval seconds until cancelled."""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush_outbox()
+            except Exception as e:
+                logger.error("Could not write outbox: %r", e)
+
+
+    async def feeder(self) -> None:
+        """Moves committed outbox entries to the in-memory queue as space frees up."""
+        while True:
+            self.flushed.clear()
+            room = self.max_queue - self.queue.qsize()
+            rows = await asyncio.to_thread(self.outbox.fetch, self.last_loaded, room) if room else []
+
+            for row in rows:
+                self.queue.put_nowait(row)
+                self.last_loaded = row[0]
+
+            # Possibility: Queue full -> Give the workers some time
+            if not room:
+                await asyncio.sleep(self.flush_interval)
+            # Possibility: All caught up -> Wait for the next flush with new entries
+            elif not rows:
+                await self.flushed.wait()
+
+
+    def get_chat_bucket(self, chat_id) -> TokenBucket:
+        """Returns the token bucket of a chat, dropping idle buckets now and then."""
+        if len(self.chat_buckets) > 10000:
+            self.chat_buckets = {k: v for k, v in self.chat_buckets.items() if not v.is_idle()}
+        if chat_id not in self.chat_buckets:
+            self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return self.chat_buckets[chat_id]
+
+
+    async def worker(self) -> None:
+        """Takes messages from the queue and sends them until cancelled."""
+        while True:
+            row_id, chat_id, text, kwargs, queued_at = await self.queue.get()
+            try:
+                await self.deliver(chat_id, text, kwargs)
+                self.latencies.append(time.time() - queued_at)
+                metrics.DELIVERY_DELAY_SECONDS.observe(self.latencies[-1])
+            except Exception as e:
+                # Never let a single message take down a worker
+                self.failed += 1
+                logger.debug("Unexpected error sending to %s: %r", chat_id, e, extra={"chat_id": chat_id})
+            finally:
+                # Handled either way -> Don't replay after a restart
+                if row_id is not None:
+                    self.outbox.ack(row_id)
+                self.queue.task_done()
+
+
+    async def deliver(self, chat_id, text, kwargs) -> None:
+        """Sends one message. Retries on RetryAfter & network errors with backoff."""
+
+        for attempt in range(self.max_retries + 1):
+
+            await self.get_chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                self.sent += 1
+                metrics.TELEGRAM_SENDS.labels("ok").inc()
+                return
+
+            # User blocked the bot -> Let the owner decide what to do, don't retry
+            except Forbidden:
+                self.forbidden += 1
+                metrics.TELEGRAM_SENDS.labels("forbidden").inc()
+                if self.on_forbidden:
+                    await self.on_forbidden(chat_id)
+                return
+
+            # Flood control -> Wait as long as Telegram asks us to
+            except RetryAfter as e:
+                self.retried += 1
+                metrics.TELEGRAM_SENDS.labels("retry").inc()
+                await asyncio.sleep(e.retry_after)
+
+            # Network hiccup -> Exponential backoff with jitter
+            except (TimedOut, NetworkError):
+                self.retried += 1
+                metrics.TELEGRAM_SENDS.labels("retry").inc()
+                await asyncio.sleep(min(30, 2 ** attempt) * (0.5 + random.random()))
+
+            # Anything else (i.e. BadRequest) won't get better by retrying
+            except TelegramError as e:
+                self.failed += 1
+                metrics.TELEGRAM_SENDS.labels("failed").inc()
+                logger.warning("Could not send to %s: %s", chat_id, e, extra={"chat_id": chat_id})
+                return
+
+        self.failed += 1
+        metrics.TELEGRAM_SENDS.labels("failed").inc()
+        logger.warning("Gave up on %s after %d retries", chat_id, self.max_retries, extra={"chat_id": chat_id})
+
+
+    def stats(self) -> dict:
+        """
+        Returns queue depth, throughput (msg/s since start), latency percentiles (s)
+        and, with an outbox, its backlog & drain rate (msg/s over the last minute).
+        """
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return latencies[int(p * (len(latencies) - 1))] if latencies else 0.0
+
+        return {
+            "queue depth": self.queue.qsize() if self.queue else 0,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "forbidden": self.forbidden,
+            "throughput": self.sent / elapsed if elapsed else 0.0,
+            "latency p50": percentile(0.5),
+            "latency p99": percentile(0.99),
+            "backlog": self.outbox.backlog if self.outbox else 0,
+            "drain rate": self.outbox.drain_rate() if self.outbox else 0.0,
+        }
+
+
+    async def reporter(self) -> None:
+        """Logs stats() every report_interval seconds if anything was sent."""
+        last_sent = 0
+        while True:
+            await asyncio.sleep(self.report_interval)
+            stats = self.stats()
+            if self.sent != last_sent or stats["queue depth"] or stats["backlog"]:
+                last_sent = self.sent
+                logger.info(
+                    "%d queued, %d sent, %.1f msg/s, p50 %.2fs, p99 %.2fs, %d in outbox (draining %.1f msg/s)",
+                    stats["queue depth"], stats["sent"], stats["throughput"], stats["latency p50"],
+                    stats["latency p99"], stats["backlog"], stats["drain rate"],
+                    extra={"stats": stats}
+                )
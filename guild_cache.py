@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In this file the GuildCache class is defined. It keeps the guild metadata the
+Telegram menus need (filtered channels, role names, members by name) so
+menu interactions are dictionary lookups instead of walks over the guild.
+Parts are built lazily and dropped by the Discord bot's guild events.
+"""
+
+from config import get_config
+
+
+class GuildMetadata:
+    """Metadata of one guild. Every part is None until first requested."""
+
+    def __init__(self):
+        self.channels = None
+        self.channels_config = None
+        self.roles = None
+        # {"name#1234": member} & {name or nick: member}, see get_member_named()
+        self.members_by_tag = None
+        self.members_by_name = None
+
+
+class GuildCache:
+    """Lazily built, event invalidated metadata of all guilds {guild id: GuildMetadata}."""
+
+    # Channels with any of these in their name are never offered in the menus
+    channel_filter = ("ticket", "closed")
+
+    def __init__(self):
+        self.guilds = {}
+
+
+    def get(self, guild_id) -> GuildMetadata:
+        return self.guilds.setdefault(guild_id, GuildMetadata())
+
+
+    def invalidate(self, guild_id, part=None) -> None:
+        """Drops one part ("channels", "roles", "members") or all metadata of a guild."""
+        if part is None:
+            self.guilds.pop(guild_id, None)
+        elif guild_id in self.guilds:
+            metadata = self.guilds[guild_id]
+            if part == "members":
+                metadata.members_by_tag = metadata.members_by_name = None
+            else:
+                setattr(metadata, part, None)
+
+
+    def clear(self) -> None:
+        self.guilds = {}
+
+
+    def get_channels(self, guild) -> dict:
+        """{name: id} of the guild's text channels in the allowed categories, minus filtered ones."""
+        metadata = self.get(guild.id)
+        config = get_config()
+
+        # Possibility: Config got reloaded -> Allowed categories may have changed
+        if metadata.channels is None or metadata.channels_config is not config:
+            allowed_channel_categories = config.allowed_channel_categories
+            metadata.channels = {
+                channel.name: channel.id for channel in guild.channels
+                if "text" in channel.type
+                and not any(x in channel.name for x in self.channel_filter)
+                and channel.category_id in allowed_channel_categories
+            }
+            metadata.channels_config = config
+
+        return metadata.channels
+
+
+    def get_roles(self, guild) -> list:
+        """Names of all roles of the guild."""
+        metadata = self.get(guild.id)
+        if metadata.roles is None:
+            metadata.roles = [role.name for role in guild.roles]
+        return metadata.roles
+
+
+    def get_member_named(self, guild, name) -> "discord.Member":
+        """Same lookup as discord.Guild.get_member_named(), from a prebuilt map."""
+        metadata = self.get(guild.id)
+
+        if metadata.members_by_name is None:
+            metadata.members_by_tag, metadata.members_by_name = {}, {}
+            # Keep the first match like Guild.get_member_named() does
+            for member in guild.members:
+                metadata.members_by_tag.setdefault(f"{member.name}#{member.discriminator}", member)
+                metadata.members_by_name.setdefault(member.name, member)
+                if member.nick:
+                    metadata.members_by_name.setdefault(member.nick, member)
+
+        # Possibility: "name#1234" given -> Exact match first, then fall back to name
+        if len(name) > 5 and name[-5] == "#" and name in metadata.members_by_tag:
+            return metadata.members_by_tag[name]
+        return metadata.members_by_name.get(name)
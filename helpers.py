@@ -2,17 +2,6 @@
 This file contains contains helper functions callable by any of the 2 bots.
 '''
 
-import logging
-import pickle
-
-
-def log(msg, level="INFO") -> None:
-    msg = (75*"~")+"\n"+msg+"\n"+(75*"~")+"\n"
-    if level == 'INFO':
-        logging.info(msg)
-    if level == "DEBUG":
-        logging.debug(msg)
-
 
 def return_pretty(d, len_lines=None, prefix="\n", suffix="\n") -> str:
     """Some custom string formatting for dictionaries. Skips empty entries."""
@@ -39,8 +28,3 @@ def iter_to_str(iterable, ignore_list=[], prefix="\n\n", suffix="\n\n") -> str:
     contents = "\n".join(iterable)
 
     return str(prefix+contents+suffix)
-
-
-def write_to_pickle(obj, filepath):
-    with open(filepath, 'wb') as handle:
-        pickle.dump(obj, handle, protocol=pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In this file the logging setup of both bots is defined. Records are written
+as one JSON object per line. Each subsystem logs to its own logger below
+"bot" (bot.discord, bot.telegram, bot.dispatcher, ...), so levels can be set
+per subsystem and high-volume loggers (bot.discord.messages) can be sampled.
+
+Messages use %-style arguments, i.e. logger.debug("%s mentions", n), so they
+are only formatted if the record is actually emitted. Extra fields are passed
+as logger.info("Sent", extra={"chat_id": 1}) and end up as JSON keys.
+"""
+
+import json, logging, random, sys
+
+# Attributes every LogRecord has. Anything else was passed via extra={...}
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+def get_logger(subsystem) -> logging.Logger:
+    """Returns the logger of a subsystem, i.e. get_logger("discord") -> bot.discord."""
+    return logging.getLogger(f"bot.{subsystem}")
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as single-line JSON objects."""
+
+    def format(self, record) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class SampleFilter(logging.Filter):
+    """
+    Lets through about `rate` of all records below WARNING (0.01 -> 1%).
+    Emitted records carry the rate, so counts can be scaled back up.
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        if random.random() >= self.rate:
+            return False
+        record.sample_rate = self.rate
+        return True
+
+
+def setup_logging(level="INFO", levels=None, sample_rates=None, stream=sys.stderr) -> None:
+    """
+    Routes all logging (incl. discord.py, telegram & httpx) through one JSON
+    lines handler. levels: {logger name: level}, i.e. {"bot.discord": "DEBUG"}.
+    sample_rates: {logger name: rate}, i.e. {"bot.discord.messages": 0.01}.
+    """
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JsonFormatter())
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+
+    for name, name_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(name_level)
+
+    for name, rate in (sample_rates or {}).items():
+        logging.getLogger(name).addFilter(SampleFilter(rate))
@@ -8,20 +8,34 @@ notification triggers accordingly and listening to Discord events.
 Written by Al Matty - github.com/al-matty
 """
 
-import logging
+import time
+start_time = time.perf_counter()    # Before the heavy imports, for time-to-ready logs
 from telegram_bot import TelegramBot
 from discord_bot import DiscordBot
+from config import get_config
+from logs import setup_logging
 import asyncio
 
-# Configure logging
-logging.basicConfig(format="%(asctime)s :\n%(message)s", level=logging.INFO)
-logger = logging.getLogger(__name__)
-# Toggle more extensive logging (bot data, Discord messages, TG inline button presses)
+# Toggle more extensive logging (sets the level of all bot.* loggers to DEBUG)
 debug_mode = False
 
-# Instantiate bots
-disc_bot = DiscordBot(debug_mode=debug_mode)
-tg_bot = TelegramBot(disc_bot, debug_mode=debug_mode)
 
-# Initialize Telegram bot. Discord bot gets initialized from within TG bot instance
-asyncio.run(tg_bot.run())
+def main() -> None:
+    # JSON lines logging. Per-subsystem levels & sampling via LOG_LEVELS & LOG_SAMPLE_RATES
+    setup_logging(
+        levels={"bot": "DEBUG" if debug_mode else "INFO", **get_config().log_levels},
+        sample_rates=get_config().log_sample_rates
+    )
+
+    # Instantiate bots
+    disc_bot = DiscordBot()
+    tg_bot = TelegramBot(disc_bot)
+    disc_bot.started_at = tg_bot.started_at = start_time
+
+    # Initialize Telegram bot. Discord bot gets initialized from within TG bot instance
+    asyncio.run(tg_bot.run())
+
+
+# Sender processes (SENDER_PROCESSES) are spawned & re-import this file as __mp_main__
+if __name__ == "__main__":
+    main()
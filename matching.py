@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In this file the matching engine of the Discord bot is defined. It decides
+who gets notified about a Discord message & with which header, without any
+I/O: a snapshot of the subscriptions and the relevant facts of a message go
+in, a list of notifications comes out. Both inputs are plain data, so the
+engine can be benchmarked on its own or run in a worker thread or process.
+
+Snapshots are immutable (frozensets in read-only mappings). The Discord bot
+publishes a new one by replacing its reference, so a reader holding a
+snapshot never sees a half-applied change.
+"""
+
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import FrozenSet, List, Mapping, NamedTuple, Optional, Tuple
+from logs import get_logger
+
+message_logger = get_logger("discord.messages")
+
+
+def freeze_sets(mapping) -> Mapping:
+    """Immutable copy of {key: set}, i.e. a read-only {key: frozenset}."""
+    return MappingProxyType({key: frozenset(value) for key, value in mapping.items()})
+
+
+def patch_sets(frozen, source, keys) -> Mapping:
+    """
+    Copy-on-write update of a freeze_sets() mapping: only the given keys are
+    frozen again from source (dropped if empty there), all other frozensets
+    are shared with the old mapping. The top-level dict itself is copied, so
+    a patch costs O(size of the mapping), not O(changed keys).
+    """
+    entries = dict(frozen)
+    for key in keys:
+        value = source.get(key)
+        if value:
+            entries[key] = frozenset(value)
+        else:
+            entries.pop(key, None)
+    return MappingProxyType(entries)
+
+
+@dataclass(frozen=True)
+class Subscriptions:
+    """Immutable snapshot of the lookups of the Discord bot the engine reads."""
+
+    # All known Telegram users (recipients of broadcasts)
+    users: FrozenSet[int]
+    # Telegram users with a verified Discord account
+    verified: FrozenSet[int]
+    # {"handles": {(guild id, member id): {TG id}}, "roles": {(guild id, role id): {TG id}}}
+    trigger_index: Mapping[str, Mapping[Tuple[int, int], FrozenSet[int]]]
+    # {channel id: {TG id}} of users with a whitelist & the users without one
+    channel_subscribers: Mapping[int, FrozenSet[int]]
+    unrestricted_users: FrozenSet[int]
+
+    @classmethod
+    def build(cls, users, verified, trigger_index, channel_subscribers, unrestricted_users) -> "Subscriptions":
+        """Full snapshot of the given (mutable) lookups."""
+        return cls(
+            users=frozenset(users),
+            verified=frozenset(verified),
+            trigger_index=MappingProxyType(
+                {category: freeze_sets(index) for category, index in trigger_index.items()}
+            ),
+            channel_subscribers=freeze_sets(channel_subscribers),
+            unrestricted_users=frozenset(unrestricted_users)
+        )
+
+
+EMPTY_SUBSCRIPTIONS = Subscriptions.build(set(), set(), {"handles": {}, "roles": {}}, {}, set())
+
+
+class MessageInfo(NamedTuple):
+    """The parts of a discord.Message the engine needs, as plain (picklable) data."""
+
+    guild_id: int
+    channel_id: int
+    channel_name: str
+    url: str
+    author_name: str
+    author_nick: Optional[str]
+    # Ids of the mentioned members & (id, name) of the mentioned roles, incl. @everyone
+    mentions: Tuple[int, ...]
+    role_mentions: Tuple[Tuple[int, str], ...]
+    created_at: float
+
+    @classmethod
+    def from_message(cls, message) -> "MessageInfo":
+        roles = list(message.role_mentions)
+        # Add in mention of @everyone as role mention
+        if message.mention_everyone:
+            roles.append(message.guild.default_role)
+        return cls(
+            guild_id=message.guild.id,
+            channel_id=message.channel.id,
+            channel_name=message.channel.name,
+            url=message.jump_url,
+            author_name=message.author.name,
+            author_nick=getattr(message.author, "nick", None),
+            mentions=tuple(user.id for user in message.mentions),
+            role_mentions=tuple((role.id, role.name) for role in roles),
+            created_at=message.created_at.timestamp()
+        )
+
+
+class Notification(NamedTuple):
+    """One Telegram message to send: who, why ("you" and/or role names) & its header."""
+
+    recipient: int
+    reasons: Tuple[str, ...]
+    header: str
+
+
+def broadcast_header(info) -> str:
+    """Header of a message in an always active channel."""
+    return f"\n🌀<i>{info.author_name}</i> posted in <a href='{info.url}'>{info.channel_name}</a>:\n\n"
+
+
+def mention_header(info, reasons) -> str:
+    """Header of a notification, naming all reasons (you, roles) in one line."""
+
+    url, channel = info.url, info.channel_name
+
+    # Only mentioned directly
+    if reasons == ("you",):
+        author = info.author_nick or info.author_name
+        return f"\nMentioned by 🌀<i>{author}</i> in <a href='{url}'>{channel}</a>:\n\n"
+
+    mentioned = ", ".join(f"<i>{reason}</i>" for reason in reasons)
+    return f"🌀<i>{info.author_name}</i> mentioned {mentioned} in <a href='{url}'>{channel}</a>:\n\n"
+
+
+def match_message(subscriptions, info, always_active_channels=frozenset()) -> List[Notification]:
+    """
+    Returns one Notification per Telegram user to notify about a message.
+    Messages in always active channels go to everyone. Otherwise a user is
+    notified if their handle or one of their roles was mentioned (guild match
+    is implied by the index key), the channel is whitelisted (or they have no
+    whitelist) and their Discord is verified.
+    """
+
+    # If message in non-deactivatable channel -> Forward to everyone known to TG bot
+    if info.channel_id in always_active_channels:
+        header = broadcast_header(info)
+        return [Notification(TG_id, (), header) for TG_id in subscriptions.users]
+
+    mentioned = [("handles", member_id, "you") for member_id in info.mentions]
+    mentioned += [("roles", role_id, name) for role_id, name in info.role_mentions]
+
+    recipients = {}
+    subscribers = subscriptions.channel_subscribers.get(info.channel_id, frozenset())
+
+    # Only look up the mentioned members & roles in the index
+    for category, discord_id, reason in mentioned:
+
+        TG_ids = subscriptions.trigger_index[category].get((info.guild_id, discord_id))
+
+        if not TG_ids:
+            continue
+
+        # Condition 1: No channels set up or channel whitelisted
+        for _id in (TG_ids & subscriptions.unrestricted_users) | (TG_ids & subscribers):
+
+            # Condition 2: User Discord is verified
+            if _id not in subscriptions.verified:
+                message_logger.debug("Unverified Discord, no notification sent", extra={"chat_id": _id})
+                continue
+
+            reasons = recipients.setdefault(_id, [])
+            if reason not in reasons:
+                reasons.append(reason)
+
+    notifications = []
+    for _id, reasons in recipients.items():
+        reasons = tuple(reasons)
+        notifications.append(Notification(_id, reasons, mention_header(info, reasons)))
+    return notifications
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In this file the Discord -> Telegram HTML formatting is defined. A Discord
+message is converted in a single pass over one precompiled pattern which
+resolves user, role & channel mentions, adds hyperlinks around urls and
+escapes the HTML special characters "<", ">", and "&" everywhere else.
+"""
+
+import re
+from html import escape
+
+# One alternative per token type. Text between tokens only needs escaping.
+TOKEN_PATTERN = re.compile(
+    r"""
+      <@!?(?P<user>[0-9]+)>                         # user mention
+    | <@&(?P<role>[0-9]+)>                          # role mention
+    | <\#(?P<channel>[0-9]+)>                       # channel mention
+    | (?P<url>https?://[^\s<>'"{}|\\^`[\]]+)        # url
+    """,
+    re.VERBOSE
+)
+
+
+def render_token(match, guild) -> str:
+    """Returns the HTML for a single mention or url match."""
+    kind = match.lastgroup
+    value = match.group(kind)
+
+    if kind == "url":
+        url = escape(value, quote=False)
+        return f"<a href='{url}'>{url}</a>"
+
+    if kind == "user":
+        member = guild.get_member(int(value))
+        if member:
+            name = member.nick if member.nick else member.name
+            return f"🌀<i>{escape(name, quote=False)}</i>"
+
+    elif kind == "role":
+        role = guild.get_role(int(value))
+        if role:
+            return f"🌀<i>{escape(role.name, quote=False)}</i>"
+
+    elif kind == "channel":
+        channel = guild.get_channel_or_thread(int(value))
+        if channel:
+            return f"<a href='{channel.jump_url}'>{escape(channel.name, quote=False)}</a>"
+
+    # Unknown member, role or channel
+    return escape(match.group(0), quote=False)
+
+
+def format_message(content, guild) -> str:
+    """
+    Returns content as Telegram HTML. Mentions of users & roles are replaced
+    by their names, channel mentions & urls become hyperlinks. Mentions that
+    can't be resolved on the guild are kept as (escaped) text.
+    """
+    out = []
+    pos = 0
+
+    for match in TOKEN_PATTERN.finditer(content):
+        out.append(escape(content[pos:match.start()], quote=False))
+        out.append(render_token(match, guild))
+        pos = match.end()
+
+    out.append(escape(content[pos:], quote=False))
+    return "".join(out)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In this file the Prometheus metrics of both bots are defined. They are
+served over HTTP on METRICS_PORT (see config.py) at /metrics, i.e.
+
+    curl localhost:9100/metrics
+"""
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from logs import get_logger
+
+logger = get_logger("metrics")
+
+# Recipients per message & Telegram fan-out, up to broadcasts to everyone
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 1000, 5000, 25000)
+# Delays from milliseconds (happy path) up to minutes (flood control, backlog)
+DELAY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+# ====================   DISCORD BOT   ====================
+
+DISCORD_MESSAGES = Counter(
+    "discord_messages_total", "Discord messages processed by on_message"
+)
+MESSAGE_MATCHES = Histogram(
+    "discord_message_matches", "Telegram users notified per Discord message",
+    buckets=FANOUT_BUCKETS
+)
+ON_MESSAGE_SECONDS = Histogram(
+    "discord_on_message_seconds", "Time spent in on_message per Discord message",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+)
+REFRESH_SECONDS = Histogram(
+    "discord_refresh_data_seconds", "Duration of full rebuilds of the lookups from the database",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+INDEX_SIZE = Gauge(
+    "discord_index_entries", "Entries of the Discord bot's lookups", ["index"]
+)
+
+# ====================   DISPATCHER   ====================
+
+TELEGRAM_SENDS = Counter(
+    "telegram_sends_total", "Telegram send attempts by outcome", ["outcome"]
+)
+DELIVERY_DELAY_SECONDS = Histogram(
+    "notification_delay_seconds", "Delay from Discord message to Telegram delivery",
+    buckets=DELAY_BUCKETS
+)
+OUTBOX_BACKLOG = Gauge(
+    "outbox_backlog", "Notifications queued but not handled yet"
+)
+DIGEST_NOTIFICATIONS = Counter(
+    "digest_notifications_total", "Notifications buffered for digests instead of sent right away"
+)
+DIGEST_MESSAGES = Counter(
+    "digest_messages_total", "Telegram messages sent for digests"
+)
+DIGEST_PENDING = Gauge(
+    "digest_pending", "Notifications buffered for digests, not sent yet"
+)
+
+# ====================   TELEGRAM BOT   ====================
+
+TELEGRAM_UPDATES = Counter(
+    "telegram_updates_total", "Updates received by the Telegram bot", ["type"]
+)
+OAUTH_VERIFICATIONS = Counter(
+    "telegram_oauth_verifications_total", "Discord OAuth verifications by outcome", ["outcome"]
+)
+OAUTH_SECONDS = Histogram(
+    "telegram_oauth_seconds", "Duration of Discord OAuth user lookups",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+
+
+def start_metrics_server(port) -> None:
+    """Serves all metrics on localhost:port/metrics from a background thread."""
+    start_http_server(port, addr="127.0.0.1")
+    logger.info("Serving metrics on 127.0.0.1:%d/metrics", port)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In this file the DiscordOAuth class is defined. It exchanges the OAuth2 code
+a user brings back from the Discord login for their Discord user info. All
+requests go through one pooled async HTTP client, so verifications never
+block the event loop shared by the Telegram & Discord bots.
+"""
+
+import asyncio, httpx
+from logs import get_logger
+
+logger = get_logger("oauth")
+
+
+class DiscordOAuth:
+    """Async client for Discord's OAuth2 authorization code flow."""
+
+    def __init__(
+        self,
+        client_id,
+        client_secret,
+        redirect_uri,
+        api_url="https://discordapp.com/api",
+        max_concurrent=20,
+        timeout=10
+    ):
+        """Constructor of the class. The HTTP client is created in start()."""
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.redirect_uri = redirect_uri
+        self.scope = "identify"
+        self.api_url = api_url
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self.client = None
+        self.semaphore = None
+
+
+    @property
+    def login_url(self) -> str:
+        """Link to the Discord login page redirecting back to the bot."""
+        return (
+            f"https://discordapp.com/api/oauth2/authorize?client_id={self.client_id}"
+            f"&redirect_uri={self.redirect_uri}&response_type=code&scope={self.scope}"
+        )
+
+
+    async def start(self) -> None:
+        """Creates the pooled keep-alive client. Needs a running event loop."""
+        if self.client:
+            return
+        self.semaphore = asyncio.Semaphore(self.max_concurrent)
+        self.client = httpx.AsyncClient(
+            base_url=self.api_url,
+            timeout=httpx.Timeout(self.timeout),
+            limits=httpx.Limits(
+                max_connections=self.max_concurrent,
+                max_keepalive_connections=self.max_concurrent,
+                keepalive_expiry=60
+            )
+        )
+
+
+    async def close(self) -> None:
+        if self.client:
+            await self.client.aclose()
+            self.client = None
+
+
+    async def get_access_token(self, auth_code) -> str:
+        """Exchanges the code from the login redirect for an access token."""
+        payload = {
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+            "grant_type": "authorization_code",
+            "code": auth_code,
+            "redirect_uri": self.redirect_uri,
+            "scope": self.scope
+        }
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+
+        response = await self.client.post("/oauth2/token", data=payload, headers=headers)
+        return response.json().get("access_token")
+
+
+    async def get_user_json(self, access_token) -> dict:
+        """Returns the Discord user object belonging to the access token."""
+        headers = {"Authorization": f"Bearer {access_token}"}
+        response = await self.client.get("/users/@me", headers=headers)
+        return response.json()
+
+
+    async def get_user(self, auth_code) -> dict:
+        """
+        Returns the Discord user object (keys "id", "username", ...) of whoever
+        logged in with auth_code. Returns an empty dict if Discord can't be
+        reached or rejects the code.
+        """
+        await self.start()
+
+        async with self.semaphore:
+            try:
+                access_token = await self.get_access_token(auth_code)
+                return await self.get_user_json(access_token)
+            except (httpx.HTTPError, ValueError) as e:
+                logger.warning("OAuth request failed: %r", e)
+                return {}
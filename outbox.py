@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In this file the Outbox class is defined. It is the durable part of the
+Dispatcher's queue: notifications are appended to a SQLite table and only
+deleted once they were handled, so whatever is still queued when the
+process dies gets sent after the restart. Appends & acks are buffered in
+memory and written in one transaction per flush, so a burst of messages
+costs one fsync instead of one per notification.
+
+Notifications waiting in a digest (see digest.py) are journaled in the same
+database. They are only dropped from it after their digest was appended, so
+a crash in between sends a digest twice at worst, but never loses it.
+"""
+
+import json, sqlite3, threading, time
+from collections import deque
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id              INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id         INTEGER NOT NULL,
+    text            TEXT NOT NULL,
+    kwargs          TEXT NOT NULL DEFAULT '{}',
+    queued_at       REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS digests (
+    id              INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id         INTEGER NOT NULL,
+    text            TEXT NOT NULL,
+    due_at          REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS digests_chat ON digests (chat_id);
+"""
+
+
+class Outbox:
+    """Append-only SQLite journal of outgoing notifications with batched commits."""
+
+    def __init__(self, path):
+        """Opens (and if necessary creates) the journal in WAL mode."""
+        self.path = path
+        # Flushes & reads run in worker threads (see Dispatcher), serialized by the lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        # Buffers written by the next flush(), digest changes in order [(statement, parameters)]
+        self.appended, self.acked, self.digest_changes = [], [], []
+        # Notifications not handled yet, incl. the ones left over from the last run
+        self.backlog = self.connection.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        # Digest rows get their ids here, so they can be dropped before they are written
+        self.last_digest_id = self.connection.execute("SELECT MAX(id) FROM digests").fetchone()[0] or 0
+        self.acked_total = 0
+        self.ack_history = deque([(time.monotonic(), 0)], maxlen=600)
+
+
+    def close(self) -> None:
+        self.flush()
+        with self.lock:
+            self.connection.close()
+
+
+    def append(self, chat_id, text, kwargs, queued_at=None) -> None:
+        """Buffers a notification. It is durable after the next flush()."""
+        self.appended.append((chat_id, text, json.dumps(kwargs), queued_at or time.time()))
+        self.backlog += 1
+
+
+    def ack(self, row_id) -> None:
+        """Marks a notification as handled (sent or given up). Deleted by the next flush()."""
+        self.acked.append((row_id,))
+        self.backlog -= 1
+        self.acked_total += 1
+
+
+    def add_digest(self, chat_id, text, due_at) -> int:
+        """Journals a notification buffered for a digest closing at due_at (unix time). Returns its id."""
+        self.last_digest_id += 1
+        self.digest_changes.append((
+            "INSERT INTO digests VALUES (?, ?, ?, ?)", (self.last_digest_id, chat_id, text, due_at)
+        ))
+        return self.last_digest_id
+
+
+    def set_digest_due(self, chat_id, due_at) -> None:
+        """Moves the end of a user's digest window."""
+        self.digest_changes.append(("UPDATE digests SET due_at = ? WHERE chat_id = ?", (due_at, chat_id)))
+
+
+    def drop_digests(self, ids) -> None:
+        """Removes journaled digest notifications (sent or discarded) by id."""
+        self.digest_changes += [("DELETE FROM digests WHERE id = ?", (row_id,)) for row_id in ids]
+
+
+    def load_digests(self) -> list:
+        """Returns the journaled digest notifications [(id, chat id, text, due at)] in order."""
+        with self.lock:
+            return self.connection.execute(
+                "SELECT id, chat_id, text, due_at FROM digests ORDER BY id"
+            ).fetchall()
+
+
+    def take(self) -> tuple:
+        """Takes over the buffered appends, acks & digest changes. Call from the event loop."""
+        appended, self.appended = self.appended, []
+        acked, self.acked = self.acked, []
+        digest_changes, self.digest_changes = self.digest_changes, []
+        self.ack_history.append((time.monotonic(), self.acked_total))
+        return appended, acked, digest_changes
+
+
+    def write(self, appended, acked, digest_changes=()) -> None:
+        """Writes everything from take() in one transaction. Safe to run in a thread."""
+        if not appended and not acked and not digest_changes:
+            return
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT INTO outbox (chat_id, text, kwargs, queued_at) VALUES (?, ?, ?, ?)",
+                appended
+            )
+            self.connection.executemany("DELETE FROM outbox WHERE id = ?", acked)
+            # Statement by statement, the order of adds & drops of a user matters
+            for statement, parameters in digest_changes:
+                self.connection.execute(statement, parameters)
+
+
+    def flush(self) -> None:
+        """Writes all buffered appends & acks right away."""
+        self.write(*self.take())
+
+
+    def fetch(self, after_id, limit) -> list:
+        """Returns up to limit flushed notifications [(id, chat id, text, kwargs, queued at)]."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, chat_id, text, kwargs, queued_at FROM outbox"
+                " WHERE id > ? ORDER BY id LIMIT ?",
+                (after_id, limit)
+            ).fetchall()
+        return [(row_id, chat_id, text, json.loads(kwargs), queued_at)
+                for row_id, chat_id, text, kwargs, queued_at in rows]
+
+
+    def drain_rate(self, window=60) -> float:
+        """Handled notifications per second over roughly the last `window` seconds."""
+        now, total = self.ack_history[-1]
+        for then, then_total in self.ack_history:
+            if now - then <= window:
+                break
+        return (total - then_total) / (now - then) if now > then else 0.0
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In this file the SQLite storage of the user data is defined. UserDatabase
+gives row-level access to the data and is queried directly by the Discord
+bot. SQLitePersistence plugs the same database into the Telegram application
+as a replacement for PicklePersistence.
+"""
+
+import json, os, pickle, sqlite3
+from telegram.ext import BasePersistence
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    telegram_id     INTEGER PRIMARY KEY,
+    discord_handle  TEXT,
+    discord_guild   INTEGER,
+    discord_id      INTEGER,
+    verified        INTEGER NOT NULL DEFAULT 0,
+    extra           TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS users_handle ON users (discord_guild, discord_handle);
+
+CREATE TABLE IF NOT EXISTS roles (
+    telegram_id     INTEGER NOT NULL REFERENCES users ON DELETE CASCADE,
+    role            TEXT NOT NULL,
+    PRIMARY KEY (telegram_id, role)
+);
+CREATE INDEX IF NOT EXISTS roles_role ON roles (role);
+
+CREATE TABLE IF NOT EXISTS channels (
+    telegram_id     INTEGER NOT NULL REFERENCES users ON DELETE CASCADE,
+    channel         TEXT NOT NULL,
+    PRIMARY KEY (telegram_id, channel)
+);
+CREATE INDEX IF NOT EXISTS channels_channel ON channels (channel);
+
+CREATE TABLE IF NOT EXISTS blobs (
+    key             TEXT PRIMARY KEY,
+    value           BLOB
+);
+
+CREATE TABLE IF NOT EXISTS conversations (
+    name            TEXT NOT NULL,
+    key             TEXT NOT NULL,
+    state           BLOB NOT NULL,
+    PRIMARY KEY (name, key)
+);
+"""
+
+# user_data keys stored in their own columns. Everything else goes to "extra".
+COLUMNS = {
+    "discord handle": "discord_handle",
+    "discord guild": "discord_guild",
+    "discord id": "discord_id",
+}
+
+
+class UserDatabase:
+    """Row-level access to the user data {telegram id: {data}} stored in SQLite."""
+
+    def __init__(self, path):
+        """Opens (and if necessary creates) the database in WAL mode."""
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("PRAGMA foreign_keys=ON")
+        self.connection.executescript(SCHEMA)
+
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+    def load_users(self) -> dict:
+        """Returns {telegram id: {data}} for all users, in the format the bots use."""
+        users = {}
+        query = "SELECT telegram_id, discord_handle, discord_guild, discord_id, verified, extra FROM users"
+
+        for TG_id, handle, guild, discord_id, verified, extra in self.connection.execute(query):
+            user_data = json.loads(extra)
+            for key, value in zip(COLUMNS, (handle, guild, discord_id)):
+                if value is not None:
+                    user_data[key] = value
+            user_data["verified discord"] = bool(verified)
+            user_data["discord roles"] = set()
+            user_data["discord channels"] = set()
+            users[TG_id] = user_data
+
+        for TG_id, role in self.connection.execute("SELECT telegram_id, role FROM roles"):
+            users[TG_id]["discord roles"].add(role)
+
+        # Channel ids (old databases may still hold channel names, see DiscordBot.migrate_channels)
+        for TG_id, channel in self.connection.execute("SELECT telegram_id, channel FROM channels"):
+            users[TG_id]["discord channels"].add(int(channel) if channel.isdigit() else channel)
+
+        return users
+
+
+    def save_user(self, TG_id, user_data) -> None:
+        """Inserts or replaces one user incl. their roles & channels in one transaction."""
+
+        extra = {
+            k: v for k, v in user_data.items()
+            if k not in COLUMNS and k not in ("verified discord", "discord roles", "discord channels")
+        }
+        roles = user_data.get("discord roles", set())
+        # Possibility: Only one role set up (stored as str)
+        if isinstance(roles, str):
+            roles = {roles}
+
+        with self.connection:
+            self.connection.execute("DELETE FROM roles WHERE telegram_id = ?", (TG_id,))
+            self.connection.execute("DELETE FROM channels WHERE telegram_id = ?", (TG_id,))
+            self.connection.execute(
+                "INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    TG_id,
+                    *(user_data.get(k) for k in COLUMNS),
+                    int(bool(user_data.get("verified discord"))),
+                    json.dumps(extra),
+                )
+            )
+            self.connection.executemany(
+                "INSERT INTO roles VALUES (?, ?)", [(TG_id, r) for r in roles]
+            )
+            self.connection.executemany(
+                "INSERT INTO channels VALUES (?, ?)",
+                [(TG_id, c) for c in user_data.get("discord channels", set())]
+            )
+
+
+    def delete_user(self, TG_id) -> bool:
+        """Deletes one user. Returns True if the user existed."""
+        with self.connection:
+            cursor = self.connection.execute("DELETE FROM users WHERE telegram_id = ?", (TG_id,))
+        return cursor.rowcount > 0
+
+
+    def delete_users(self, TG_ids) -> int:
+        """Deletes many users in one transaction. Returns how many existed."""
+        with self.connection:
+            cursor = self.connection.executemany(
+                "DELETE FROM users WHERE telegram_id = ?", [(TG_id,) for TG_id in TG_ids]
+            )
+        return cursor.rowcount
+
+
+    def get_blob(self, key):
+        """Returns the unpickled object stored under key or None."""
+        row = self.connection.execute("SELECT value FROM blobs WHERE key = ?", (key,)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+
+    def set_blob(self, key, obj) -> None:
+        """Stores any picklable object under key."""
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO blobs VALUES (?, ?)",
+                (key, pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+            )
+
+
+    def load_conversations(self, name) -> dict:
+        """Returns the states {conversation key: state} of one ConversationHandler."""
+        # Older databases kept all states of a handler in one blob -> Move them to rows once
+        legacy = self.get_blob(f"conversations {name}")
+        if legacy is not None:
+            with self.connection:
+                for key, state in legacy.items():
+                    self.save_conversation(name, key, state)
+                self.connection.execute("DELETE FROM blobs WHERE key = ?", (f"conversations {name}",))
+
+        query = "SELECT key, state FROM conversations WHERE name = ?"
+        return {
+            tuple(json.loads(key)): pickle.loads(state)
+            for key, state in self.connection.execute(query, (name,))
+        }
+
+
+    def save_conversation(self, name, key, state) -> None:
+        """Stores the state of one conversation (None: conversation ended, row deleted)."""
+        key = json.dumps(list(key))
+        with self.connection:
+            if state is None:
+                self.connection.execute(
+                    "DELETE FROM conversations WHERE name = ? AND key = ?", (name, key)
+                )
+            else:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)",
+                    (name, key, pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+                )
+
+
+    def import_pickle(self, filepath) -> None:
+        """One-off import of the user data of an old PicklePersistence file."""
+        if not os.path.isfile(filepath):
+            return
+        if self.connection.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+            return    # Already imported
+
+        with open(filepath, "rb") as handle:
+            data = pickle.load(handle)
+
+        for TG_id, user_data in data.get("user_data", {}).items():
+            if user_data:
+                self.save_user(TG_id, user_data)
+
+
+class SQLitePersistence(BasePersistence):
+    """Persistence for the Telegram application writing user data row by row."""
+
+    def __init__(self, filepath, store_data=None, update_interval=60):
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self.db = UserDatabase(filepath)
+
+
+    async def get_user_data(self) -> dict:
+        return self.db.load_users()
+
+
+    async def update_user_data(self, user_id, data) -> None:
+        # Users who wiped their data don't need a row
+        if data:
+            self.db.save_user(user_id, data)
+        else:
+            self.db.delete_user(user_id)
+
+
+    async def drop_user_data(self, user_id) -> None:
+        self.db.delete_user(user_id)
+
+
+    async def refresh_user_data(self, user_id, user_data) -> None:
+        pass
+
+
+    async def get_callback_data(self):
+        return self.db.get_blob("callback_data")
+
+
+    async def update_callback_data(self, data) -> None:
+        self.db.set_blob("callback_data", data)
+
+
+    async def get_conversations(self, name) -> dict:
+        return self.db.load_conversations(name)
+
+
+    async def update_conversation(self, name, key, new_state) -> None:
+        self.db.save_conversation(name, key, new_state)
+
+
+    # Chat data & bot data aren't used by this bot
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def update_chat_data(self, chat_id, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data) -> None:
+        pass
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+
+    async def flush(self) -> None:
+        self.db.close()
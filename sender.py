@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In this file the ProcessBot class is defined. It stands in for telegram.Bot
+in the Dispatcher and hands every send_message() call to a pool of sender
+processes over a multiprocessing queue. The results (incl. Forbidden,
+RetryAfter, ...) flow back over a second queue, so the Dispatcher keeps
+rate limiting, retries, the outbox & blocked user handling in one place,
+while the HTTP requests to Telegram run on other cores than the event loop
+serving the Discord gateway & the Telegram menus.
+"""
+
+import asyncio, itertools, multiprocessing, threading
+from concurrent.futures import ThreadPoolExecutor
+from telegram import Bot
+from telegram.error import TelegramError, TimedOut
+from logs import get_logger
+
+logger = get_logger("sender")
+
+
+async def serve(bot_class, token, jobs, results, concurrency) -> None:
+    """Sends messages from the jobs queue with `concurrency` workers, each until a None job."""
+    loop = asyncio.get_running_loop()
+    # One thread per worker blocking on the queue
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def worker(bot):
+        while True:
+            job = await loop.run_in_executor(executor, jobs.get)
+            if job is None:
+                return
+            job_id, chat_id, text, kwargs = job
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                results.put((job_id, None))
+            except TelegramError as e:
+                results.put((job_id, e))
+            # Anything else might not survive pickling -> Report as plain failure
+            except Exception as e:
+                results.put((job_id, TelegramError(repr(e))))
+
+    async with bot_class(token) as bot:
+        await asyncio.gather(*(worker(bot) for _ in range(concurrency)))
+    executor.shutdown()
+
+
+def sender_process(bot_class, token, jobs, results, concurrency) -> None:
+    """Entry point of a sender process."""
+    try:
+        asyncio.run(serve(bot_class, token, jobs, results, concurrency))
+    except KeyboardInterrupt:
+        pass
+
+
+class ProcessBot:
+    """Drop-in for telegram.Bot.send_message() backed by sender processes."""
+
+    def __init__(self, token, processes=2, concurrency=8, timeout=60, bot_class=Bot):
+        """
+        Constructor of the class. The processes are spawned in start(). Each one
+        sends with a bot_class(token) instance & `concurrency` parallel requests.
+        """
+        self.token = token
+        self.bot_class = bot_class
+        # Seconds until a send counts as timed out (i.e. sender process died)
+        self.timeout = timeout
+        self.n_processes = processes
+        self.concurrency = concurrency
+        self.processes = []
+        self.jobs, self.results = None, None
+        self.pending = {}
+        self.job_ids = itertools.count()
+        self.loop = None
+        self.reader = None
+
+
+    def start(self) -> None:
+        """Spawns the sender processes & the result reader. Needs a running event loop."""
+        if self.processes:
+            return
+        self.loop = asyncio.get_running_loop()
+        # Spawn, not fork: The parent runs an event loop & threads
+        context = multiprocessing.get_context("spawn")
+        self.jobs, self.results = context.Queue(), context.Queue()
+        self.processes = [
+            context.Process(
+                target=sender_process,
+                args=(self.bot_class, self.token, self.jobs, self.results, self.concurrency),
+                name=f"telegram-sender-{i}",
+                daemon=True
+            )
+            for i in range(self.n_processes)
+        ]
+        for process in self.processes:
+            process.start()
+        self.reader = threading.Thread(target=self.read_results, name="sender-results", daemon=True)
+        self.reader.start()
+        logger.info("Started %d sender processes", self.n_processes)
+
+
+    def stop(self) -> None:
+        """Lets the sender processes finish their current messages, then joins them."""
+        # Every worker of every process stops after taking one None
+        for _ in range(self.n_processes * self.concurrency):
+            self.jobs.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+        self.results.put(None)
+        self.processes = []
+
+
+    def read_results(self) -> None:
+        """Runs in a thread, hands results from the sender processes to the event loop."""
+        while True:
+            result = self.results.get()
+            if result is None:
+                return
+            self.loop.call_soon_threadsafe(self.resolve, *result)
+
+
+    def resolve(self, job_id, error) -> None:
+        future = self.pending.pop(job_id, None)
+        if future is None or future.done():
+            return
+        if error is None:
+            future.set_result(None)
+        else:
+            future.set_exception(error)
+
+
+    async def send_message(self, chat_id, text, **kwargs) -> None:
+        """Sends from a sender process. Raises the same errors as telegram.Bot."""
+        job_id = next(self.job_ids)
+        future = self.loop.create_future()
+        self.pending[job_id] = future
+        self.jobs.put((job_id, chat_id, text, kwargs))
+        try:
+            await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            # Dispatcher retries TimedOut with backoff
+            raise TimedOut(f"No answer from sender processes within {self.timeout}s")
+        finally:
+            self.pending.pop(job_id, None)
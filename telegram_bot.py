@@ -7,11 +7,15 @@ Send /start to initiate the conversation on Telegram. Press Ctrl-C on the
 command line to stop the bot.
 """
 
-import logging, os, random, asyncio, requests, json
-from helpers import log, iter_to_str, return_pretty
-from pandas import read_pickle
+import logging, random, asyncio, time
+from urllib.parse import urlparse
+from helpers import iter_to_str, return_pretty
+from logs import get_logger
+from persistence import SQLitePersistence
+from oauth import DiscordOAuth
+from config import get_config, reload_on_sighup
+import metrics
 from typing import Dict, Union, List
-from dotenv import load_dotenv
 from pprint import pp
 from warnings import filterwarnings
 from telegram.warnings import PTBUserWarning
@@ -29,37 +33,94 @@ from telegram.ext import (
     ConversationHandler,
     MessageHandler,
     CallbackQueryHandler,
-    PicklePersistence,
     PersistenceInput,
+    TypeHandler,
     filters,
 )
 
-load_dotenv("./.env")
 filterwarnings(action="ignore", message=r".*CallbackQueryHandler", category=PTBUserWarning)
 
+logger = get_logger("telegram")
+
+
+# Updates PTB hands to SerializedApplication at once (running or waiting for their chat)
+PENDING_UPDATES = 1024
+
+
+class SerializedApplication(Application):
+    """
+    Application processing updates concurrently (see CONCURRENT_UPDATES), except
+    for updates of the same chat, which run one after another. That keeps the
+    conversation state & user_data of each user consistent.
+
+    PTB takes its concurrency slot before process_update is called, so updates
+    waiting for a busy chat would hold slots & starve other chats. PTB's limit
+    is therefore only a cap on pending updates (PENDING_UPDATES), the actual
+    limit is a semaphore taken once the chat lock is held.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # {chat id: [lock, # of updates holding or waiting for it]}
+        self.chat_locks = {}
+        # Created in the first update so it is bound to the running loop
+        self.handler_slots = None
+
+
+    async def process_update(self, update) -> None:
+        if self.handler_slots is None:
+            self.handler_slots = asyncio.Semaphore(get_config().concurrent_updates)
+
+        chat_id = update.effective_chat.id if update.effective_chat else None
+        if chat_id is None:
+            async with self.handler_slots:
+                return await super().process_update(update)
+
+        chat_locks = self.chat_locks
+        entry = chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self.handler_slots:
+                await super().process_update(update)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del chat_locks[chat_id]
+
 
 class TelegramBot:
     """A class to encapsulate all relevant methods of the Telegram bot."""
 
-    def __init__(self, discord_bot_instance, debug_mode=False):
+    def __init__(self, discord_bot_instance):
         """
         Constructor of the class. Initializes certain instance variables.
         """
-        # The single data file the bot is using
-        self.data_path = "./data"
+        # The single database file the bot is using
+        self.data_path = "./data.sqlite"
+        # Pickle file used by earlier versions, imported once into the database
+        self.legacy_data_path = "./data"
         # Discord bot instance
         self.discord_bot = discord_bot_instance
-        # Switch on logging of bot data & callback data (inline button presses) for debugging
-        self.debug_mode = debug_mode
         # Set up conversation states & inline keyboard
         self.CHOOSING, self.TYPING_REPLY = range(2)
         reply_keyboard = [
             ["Discord handle", "Discord channels"],
             ["Discord roles", "Discord guild",],
-            ["Delete my data", "Done"]
+            ["Delivery mode", "Delete my data"],
+            ["Done"]
         ]
         self.markup = ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True)
+        # Digest windows (minutes) offered in the delivery mode menu
+        self.digest_intervals = (15, 30, 60)
         self.application = None
+        # Async client verifying Discord logins (started in run)
+        self.oauth = DiscordOAuth(
+            client_id=get_config().oauth_client_id,
+            client_secret=get_config().oauth_client_secret,
+            redirect_uri=get_config().oauth_redirect_uri
+        )
+        # Reference point for the time-to-ready log (main.py sets it to process start)
+        self.started_at = time.perf_counter()
 
 
     def set_discord_instance(self, bot) -> None:
@@ -73,6 +134,8 @@ class TelegramBot:
         since anything after starting the Discord bot will only be run after
         the Discord bot is closed.
         """
+        # Settings changed since the start are only in memory yet, the Discord bot loads the database
+        await self.application.update_persistence()
         await self.discord_bot.run_bot()
 
 
@@ -91,12 +154,13 @@ class TelegramBot:
 
         context.user_data["discord roles"] = set()
         context.user_data["discord channels"] = set()
-        context.user_data["discord guild"] = int(os.getenv("DEFAULT_GUILD"))
+        context.user_data["discord guild"] = get_config().default_guild
         context.user_data["last callback"] = None
         context.user_data["verified discord"] = False
         context.user_data["discord id"] = None
 
-        await self.refresh_discord_bot()
+        # Relay new user to Discord bot
+        self.discord_bot.update_user(update.effective_user.id, context.user_data)
         return
 
 
@@ -112,7 +176,7 @@ class TelegramBot:
     async def start_wrapper(self, update, context) -> int:
         """Necessary for Oauth2 flow. Calls either menu or Discord verification."""
         if context.args not in ([], None):
-            auth_code = context.args
+            auth_code = context.args[0]
             return await self.set_verification_status(auth_code, update, context)
         else:
             return await self.start(update, context)
@@ -133,8 +197,12 @@ class TelegramBot:
         # Possibility: Known user -> show active notifications & button menu
         if user_data and user_data != {}:
 
+            # Possibility: Dropped by the Discord bot after blocking it -> Link them again
+            # (their database row gets written again with the next persistence flush)
+            if chat_id not in self.discord_bot.users:
+                self.discord_bot.update_user(chat_id, user_data)
+
             # Get current notification triggers from Discord bot
-            await self.refresh_discord_bot()
             active_notifications = await self.discord_bot.get_active_notifications(chat_id)
 
             # Possibility: No notification triggers set yet
@@ -163,9 +231,16 @@ class TelegramBot:
             # Show Discord channel restirictions if any channels are set up
             if user_data["discord channels"] != set():
 
+                channel_names = await self.discord_bot.get_channel_names(
+                    user_data["discord guild"], user_data["discord channels"]
+                )
                 reply_text += "\nWill only notify if mentioned in channel"
-                if len(user_data["discord channels"]) > 1: reply_text += "s"
-                reply_text += f"\n{user_data['discord channels']}\n"
+                if len(channel_names) > 1: reply_text += "s"
+                reply_text += f"\n{set(channel_names)}\n"
+
+            # Show delivery mode if notifications are bundled
+            if user_data.get("digest minutes"):
+                reply_text += f"*Delivery* _digest every {user_data['digest minutes']} min_\n"
 
             # Show Discord verification status
             if user_data["verified discord"]:
@@ -181,8 +256,9 @@ class TelegramBot:
         # Possibility: New user -> show explainer & button menu
         else:
             # Add "guild", "roles", "channels" keys to user data
+            # Done once this returns: the user's next update waits for this one
+            # (see SerializedApplication), so fast users can't hit missing keys
             await self.add_placeholders(update, context)
-            await asyncio.sleep(2)    # Prevent KeyErrors with very fast users
 
             reply_text = (
                 "Hello!\n\n"
@@ -234,8 +310,7 @@ class TelegramBot:
         category = context.user_data["choice"].lower()
         button_list = []
 
-        if self.debug_mode:
-            log(f"GOT CATEGORY IN inline_submenu(): {category}")
+        logger.debug("inline_submenu(): got category %s", category)
 
         if category == "discord roles":
             buttons = ["Add roles", "Remove roles", "Back"]
@@ -275,8 +350,8 @@ class TelegramBot:
     async def roles_menu(self, update, context) -> int:
         """Discord roles main menu."""
 
-        if self.debug_mode and not update.callback_query:
-            log(f"ARRIVED AT roles_menu() WITH EMPTY CALLBACK")
+        if not update.callback_query:
+            logger.debug("Arrived at roles_menu() with empty callback")
 
         context.user_data["choice"] = "discord roles"
         guild_id = context.user_data["discord guild"]
@@ -342,7 +417,7 @@ class TelegramBot:
 
         # Send back to main menu if callback not recognized
         else:
-            if self.debug_mode: log(f"REDIRECTED TO MENU: CALLBACK DATA = {callback_data}")
+            logger.debug("Redirected to menu, callback data: %s", callback_data)
             return await self.start(update, context)
 
         # Prompt for user input
@@ -354,21 +429,23 @@ class TelegramBot:
     async def channels_menu(self, update, context) -> int:
         """Discord channels main menu."""
 
-        if self.debug_mode and not update.callback_query:
-            log(f"ARRIVED AT channels_menu() WITH EMPTY CALLBACK")
+        if not update.callback_query:
+            logger.debug("Arrived at channels_menu() with empty callback")
 
         context.user_data["choice"] = "discord channels"
         guild_id = context.user_data["discord guild"]
         discord_handle = context.user_data["discord handle"]
         guild_name = await self.discord_bot.get_guild(guild_id)
-        active_channels = context.user_data["discord channels"]
+        # Whitelist holds channel ids, the menu shows channel names
+        active_channels = set(await self.discord_bot.get_channel_names(
+            guild_id, context.user_data["discord channels"]
+        ))
         channels_available = await self.discord_bot.get_channels(guild_id)
 
-        if self.debug_mode:
-            log(
-                f"channels_menu(): CHANNELS_AVAILABLE: {channels_available}\n"
-                f"channels_menu(): ACTIVE_CHANNELS: {active_channels}"
-            )
+        logger.debug(
+            "channels_menu()",
+            extra={"channels_available": list(channels_available), "active_channels": active_channels}
+        )
 
         callback_data = update.callback_query.data
 
@@ -428,7 +505,7 @@ class TelegramBot:
 
         # Send back to main menu if callback not recognized
         else:
-            if self.debug_mode: log(f"REDIRECTED TO MENU: CALLBACK DATA = {callback_data}")
+            logger.debug("Redirected to menu, callback data: %s", callback_data)
             return await self.start(update, context)
 
         # Prompt for user input
@@ -437,10 +514,55 @@ class TelegramBot:
         return self.TYPING_REPLY
 
 
+    async def delivery_menu(self, update, context) -> int:
+        """Delivery mode menu: Every notification right away or a digest every N minutes."""
+
+        context.user_data["choice"] = "delivery mode"
+        minutes = context.user_data.get("digest minutes")
+
+        if minutes:
+            reply_text = f"Currently your notifications are bundled into a digest every {minutes} minutes. "
+        else:
+            reply_text = "Currently every notification is sent right away. "
+        reply_text += (
+            "With a digest, all notifications of a time window arrive as one message."
+            " Please choose:"
+        )
+
+        buttons = [("Immediately", "digest 0")]
+        buttons += [(f"Digest every {n} min", f"digest {n}") for n in self.digest_intervals]
+        buttons.append(("Back", "Back"))
+        button_list = [InlineKeyboardButton(x[0], callback_data=x[1]) for x in buttons]
+        reply_markup = InlineKeyboardMarkup(self.build_button_menu(button_list, n_cols=2))
+
+        await self.send_msg(reply_text, update, reply_markup=reply_markup)
+        return self.CHOOSING
+
+
+    async def set_delivery_mode(self, update, context) -> int:
+        """Stores the delivery mode chosen in delivery_menu()."""
+
+        minutes = int(update.callback_query.data.split()[-1])
+
+        if minutes:
+            context.user_data["digest minutes"] = minutes
+            reply_text = f"Notifications will be sent as a digest every {minutes} minutes."
+        else:
+            context.user_data.pop("digest minutes", None)
+            reply_text = "Notifications will be sent right away."
+
+        # Relay changes to Discord bot
+        self.discord_bot.update_user(update.effective_user.id, context.user_data)
+
+        del context.user_data["choice"]
+        await update.callback_query.message.edit_text(reply_text)
+        return await self.start(update, context)
+
+
     async def discord_guild(self, update, context) -> int:
         """Ask the user for info about the selected predefined choice."""
         context.user_data["choice"] = "discord guild"
-        default_guild = int(os.getenv("DEFAULT_GUILD"))
+        default_guild = get_config().default_guild
 
         # Prevent KeyError for new users
         if "discord guild" not in context.user_data:
@@ -470,7 +592,7 @@ class TelegramBot:
 
 
     async def delete_my_data(self, update, context) -> int:
-        """Deletes user entry from pickle file, context & Discord bot's triggers."""
+        """Deletes user entry from database, context & Discord bot's triggers."""
 
         if context.user_data == {}:
 
@@ -479,7 +601,6 @@ class TelegramBot:
                 " Back to /menu"
             )
         else:
-            await self.send_msg("Please wait...", update)
             for k in context.user_data.copy().keys():
                 del context.user_data[k]
 
@@ -488,9 +609,10 @@ class TelegramBot:
                 f"Hit /menu to start over."
             )
 
-            # Refresh Discord bot to propagate changes
-            await self.refresh_discord_bot()
-            await asyncio.sleep(2.5)
+            # Remove user from Discord bot's notification triggers & the database
+            # right away instead of with the next persistence update
+            self.discord_bot.remove_user(update.effective_user.id)
+            await self.application.persistence.drop_user_data(update.effective_user.id)
 
         # Notify user
         await self.send_msg(reply_text, update)
@@ -510,12 +632,10 @@ class TelegramBot:
         if "last callback" not in context.user_data: context.user_data["last callback"] = None
         callback_data = context.user_data["last callback"]
 
-        if self.debug_mode:
-            log(
-                f"received_information() CALLBACK_DATA: {callback_data}\n"
-                f"received_information() CATEGORY: {category}\n"
-                f"received_information() UPDATE.CALLBACK_QUERY: {update.callback_query}"
-            )
+        logger.debug(
+            "received_information()",
+            extra={"callback_data": callback_data, "category": category, "callback_query": update.callback_query}
+        )
 
         removal_triggers = ("Remove roles", "Remove channels")
         non_removable = ("discord handle", "discord guild", "delete my data")
@@ -540,9 +660,9 @@ class TelegramBot:
                 # Automatically add user roles if Discord handle exists
                 if check != None:
 
-                    to_ignore = json.loads(os.getenv("ROLES_EXEMPT_BY_DEFAULT"))
+                    to_ignore = tuple(get_config().roles_exempt_by_default)
                     all_roles = await self.discord_bot.get_user_roles(text, guild_id)
-                    roles = [r for r in all_roles if not any(r.startswith(s) for s in to_ignore)]
+                    roles = [r for r in all_roles if not r.startswith(to_ignore)]
                     # If new & valid Discord handle entered: Reset verification status
                     context.user_data["verified discord"] = False
                     if roles != []:
@@ -560,6 +680,10 @@ class TelegramBot:
             else:
                 check = True
 
+            # Channels are stored by id, so renaming a channel doesn't break the whitelist
+            if category == "discord channels" and check:
+                text = channels_available[text]
+
             # If invalid data -> Repeat prompt with notice.
             if check == None:
 
@@ -599,17 +723,17 @@ class TelegramBot:
             # Possibility: No entry yet under this key -> Create entry if in allow_list
             allow_list = ["discord handle", "discord guild"]
             if (category not in context.user_data) and (category in allow_list):
-                if self.debug_mode: log(f"received_information():\tPOSSIBILITY 1: NO KEY FOUND -> CREATE ENTRY")
+                logger.debug("received_information(): no key found -> create entry")
                 context.user_data[category] = text
 
             # Possibility: Key known & points to set -> Add to set (i.e. for roles, channels)
             elif isinstance(context.user_data[category], set):
-                if self.debug_mode: log(f"received_information():\tPOSSIBILITY 2: ADD TO SET")
+                logger.debug("received_information(): add to set")
                 context.user_data[category].add(text)
 
             # Possibility: Key known & points to anything other than a set -> Overwrite
             else:
-                if self.debug_mode: log(f"received_information():\tPOSSIBILITY 3: OVERWRITE OLD VALUE")
+                logger.debug("received_information(): overwrite old value")
                 context.user_data[category] = text
 
             # ====================   POST-STORAGE ACTIONS   ====================
@@ -627,17 +751,18 @@ class TelegramBot:
                 context.user_data["discord id"] = user_id
 
             # Relay changes to Discord bot
-            await self.refresh_discord_bot()
+            self.discord_bot.update_user(update.effective_user.id, context.user_data)
 
             # Show updated data to user
             ignore_list = ["last callback", "choice", "discord id"]
             show_data = {k: v for k, v in context.user_data.items() if k not in ignore_list}
+            show_data["discord channels"] = set(await self.discord_bot.get_channel_names(
+                context.user_data.get("discord guild"), context.user_data.get("discord channels", set())
+            ))
 
             success_msg = (
                 "Success! Your data so far:"
                 f"\n{self.parse_str(show_data)}\n"
-                " If the changes don't show up under 'current active notifications'"
-                " yet, please allow the bot about 10s, then hit /menu again."
             )
 
             # If new Discord handle has been set -> send to verification menu
@@ -661,6 +786,7 @@ class TelegramBot:
 
                 current_roles.remove(text)
                 context.user_data["discord roles"] = current_roles
+                self.discord_bot.remove_trigger(update.effective_user.id, "roles", text)
 
                 reply_text = f"\n'{text}' removed.\n"
                 reply_text += "Do you want to remove another role?"
@@ -683,11 +809,16 @@ class TelegramBot:
         # Possibility: User wants to remove a channel
         elif callback_data == "Remove channels":
 
-            current_channels = context.user_data["discord channels"]
+            current_channels = await self.discord_bot.get_channel_names(
+                context.user_data["discord guild"], context.user_data["discord channels"]
+            )
 
             if text in current_channels:
-                current_channels.remove(text)
-                context.user_data["discord channels"] = current_channels
+                channel_id = current_channels.pop(text)
+                context.user_data["discord channels"].discard(channel_id)
+                # Relay the whole whitelist: Old ones may still hold channel names here, while the
+                # Discord bot already migrated its copy to ids (also fixes this user_data in place)
+                self.discord_bot.update_user(update.effective_user.id, context.user_data)
 
                 reply_text = f"\n'{text}' removed.\n"
                 reply_text += "Do you want to remove another channel?"
@@ -706,7 +837,7 @@ class TelegramBot:
                 await self.send_msg(reply_text, update)
 
         else:
-            if self.debug_mode: log(f"UNHANDLED CALLBACK IN received_information: {callback_data}")
+            logger.debug("Unhandled callback in received_information(): %s", callback_data)
 
         return
 
@@ -724,15 +855,10 @@ class TelegramBot:
         # Hide last inline keyboard
         await query.message.edit_reply_markup()
 
-        if self.debug_mode:
-            log(
-                f"CALLBACK QUERY: {query}\n"
-                f"CALLBACK DATA: {callback_data}\n"
-                f"CATEGORY: {category}\n"
-                f"UPDATE.MESSAGE: {update.message}\n"
-                f"UPDATE.CALLBACK_QUERY.MESSAGE: {update.callback_query.message}\n"
-                f"UPDATE: {update}"
-            )
+        logger.debug(
+            "received_callback()",
+            extra={"callback_data": callback_data, "category": category, "update": update}
+        )
 
         # Possibility: User pressed "Back" -> Back to main menu
         if callback_data == "Back":
@@ -745,12 +871,13 @@ class TelegramBot:
 
             ignore_list = ["last callback", "choice"]
             show_data = {k: v for k, v in context.user_data.items() if k not in ignore_list}
+            show_data["discord channels"] = set(await self.discord_bot.get_channel_names(
+                context.user_data.get("discord guild"), context.user_data.get("discord channels", set())
+            ))
 
             success_msg = (
                 "Success! Your data so far:"
                 f"\n{self.parse_str(show_data)}\n"
-                " If the changes don't show up under 'current active notifications'"
-                " yet, please allow the bot about 10s, then hit /menu again."
             )
 
             del context.user_data["choice"]
@@ -760,7 +887,7 @@ class TelegramBot:
 
         # Possibility: User chose "Discord roles" at main menu
         elif category == "discord roles":
-            if self.debug_mode: log("category == 'discord roles'")
+            logger.debug("received_callback(): discord roles")
 
             # Possibility: No Discord username is set yet. Forward to username prompt instead.
             if "discord handle" not in context.user_data:
@@ -771,7 +898,7 @@ class TelegramBot:
 
         # Possibility: User chose "Discord channels" at main menu
         elif category == "discord channels":
-            if self.debug_mode: log("category == 'discord channels'")
+            logger.debug("received_callback(): discord channels")
 
             # Possibility: No Discord username is set yet. Forward to username prompt instead.
             if "discord handle" not in context.user_data:
@@ -780,9 +907,13 @@ class TelegramBot:
 
             return await self.channels_menu(update, context)
 
+        # Possibility: User chose a delivery mode
+        elif category == "delivery mode" and callback_data.startswith("digest "):
+            return await self.set_delivery_mode(update, context)
+
         # Any undefined button will fall back to the main menu
         else:
-            if self.debug_mode: log(f"received_callback(): UNHANDLED CALLBACK DATA: {callback_data}")
+            logger.debug("Unhandled callback in received_callback(): %s", callback_data)
             return await self.start(update, context)
 
 
@@ -800,14 +931,7 @@ class TelegramBot:
 
         else:
 
-            def build_oauth_link():
-                client_id = os.getenv("OAUTH_DISCORD_CLIENT_ID")
-                redirect_uri = os.getenv("OAUTH_REDIRECT_URI")
-                scope = "identify"
-                discord_login_url = f"https://discordapp.com/api/oauth2/authorize?client_id={client_id}&redirect_uri={redirect_uri}&response_type=code&scope={scope}"
-                return discord_login_url
-
-            oauth_link = build_oauth_link()
+            oauth_link = self.oauth.login_url
 
             msg = (
                 f"Please follow this [link]({oauth_link}) to login with Discord,"
@@ -836,90 +960,49 @@ class TelegramBot:
 
         context.args = []    # Delete received Oauth code from context object
 
-        stored_discord_user_id = context.user_data["discord id"]
-        stored_discord_handle = context.user_data["discord handle"]
+        # Not set yet (or None, which the database doesn't keep) if no handle was entered
+        stored_discord_user_id = context.user_data.get("discord id")
+        stored_discord_handle = context.user_data.get("discord handle")
 
         # Convert user id to str if necessary (json from web contains str)
         if isinstance(stored_discord_user_id, int):
             stored_discord_user_id = str(stored_discord_user_id)
 
-        def build_oauth_obj():
-            d = {}
-            d["client_id"] = os.getenv("OAUTH_DISCORD_CLIENT_ID")
-            d["client_secret"] = os.getenv("OAUTH_DISCORD_CLIENT_SECRET")
-            d["redirect_uri"] = os.getenv("OAUTH_REDIRECT_URI")
-            d["scope"] = 'identify'
-            d["discord_login_url"] = f'https://discordapp.com/api/oauth2/authorize?client_id={d["client_id"]}&redirect_uri={d["redirect_uri"]}&response_type=code&scope={d["scope"]}'
-            d["discord_token_url"] = 'https://discordapp.com/api/oauth2/token'
-            d["discord_api_url"] = 'https://discordapp.com/api'
-            return d
-
-        def get_accesstoken(auth_code, oauth):
-            payload = {
-                "client_id": oauth["client_id"],
-                "client_secret": oauth["client_secret"],
-                "grant_type": "authorization_code",
-                "code": auth_code,
-                "redirect_uri": oauth["redirect_uri"],
-                "scope": oauth["scope"]
-            }
-
-            headers = {
-                "Content-Type": "application/x-www-form-urlencoded"
-            }
-
-            access_token = requests.post(
-                url = oauth["discord_token_url"],
-                data=payload,
-                headers=headers
-            )
-
-            json = access_token.json()
-            return json.get("access_token")
-
-        def get_userjson(access_token, oauth):
-            url = oauth["discord_api_url"]+'/users/@me'
-            headers = {"Authorization": f"Bearer {access_token}"}
-            user_obj = requests.get(url=url, headers=headers)
-            user_json = user_obj.json()
-            return user_json
-
-        oauth = build_oauth_obj()
-        access_token = get_accesstoken(auth_code, oauth)
-        user_json = get_userjson(access_token, oauth)
+        # Ask Discord who logged in (non-blocking, shared connection pool)
+        with metrics.OAUTH_SECONDS.time():
+            user_json = await self.oauth.get_user(auth_code)
 
         username = user_json.get('username')
         discriminator = user_json.get('discriminator')
         user_id = user_json.get('id')
 
         # If user actually possesses user id: Set verification status to True
-        if user_id == stored_discord_user_id:
+        if user_id and user_id == stored_discord_user_id:
 
-            if self.debug_mode: log(f"OAUTH CHECK PASSED")
+            logger.debug("OAuth check passed", extra={"chat_id": update.effective_user.id})
+            metrics.OAUTH_VERIFICATIONS.labels("verified").inc()
 
             context.user_data["verified discord"] = True
 
             reply_msg = (
                 f"Success! {stored_discord_handle} verified!"
-                " If the menu below still says 'unverified', please"
-                " allow the bot a few seconds to update, then hit"
-                " /menu again."
             )
 
             # Relay changes to bot
-            self.refresh_discord_bot()
+            self.discord_bot.update_user(update.effective_user.id, context.user_data)
 
         else:
 
-            if self.debug_mode: log(f"OAUTH CHECK FAILED")
+            logger.debug("OAuth check failed", extra={"chat_id": update.effective_user.id})
+            metrics.OAUTH_VERIFICATIONS.labels("mismatch" if user_json else "error").inc()
 
             reply_msg = (
                 f"Unfortunately, neither {username} nor {username}#{discriminator} "
                 f"matches {stored_discord_handle}. Unable to verify."
             )
 
+        # Discord bot is already up to date (update_user), show the menu right away
         await self.send_msg(reply_msg, update)
-        await asyncio.sleep(1.5)
         return await self.start(update, context)
 
 
@@ -938,10 +1021,13 @@ class TelegramBot:
         """Display some quick bot data for debugging."""
 
         chat_id = update.message.chat_id if update.message else context._chat_id
-        debug_id = int(os.environ["DEBUG_ID"])
+        debug_id = get_config().debug_id
 
         if chat_id == debug_id:
 
+            # Consistency check: Full rebuild of the Discord bot's triggers
+            await self.refresh_discord_bot()
+
             guild_id = context.user_data["discord guild"]
             guild = await self.discord_bot.get_guild(guild_id)
             filter_out = ["category", "news", "forum"]
@@ -984,21 +1070,39 @@ class TelegramBot:
 
 
     async def refresh_discord_bot(self) -> None:
-        """Needs to be called for changes of notification settings to take effect."""
+        """
+        Writes all user data to the database & makes the Discord bot rebuild
+        its notification triggers from it. Settings changes are relayed with
+        DiscordBot.update_user() & co, so this is only a consistency check.
+        """
 
-        # Update pickle db
+        # Update database
         await self.application.update_persistence()
-        await asyncio.sleep(1)
 
-        # Reload pickle file in Discord bot & update notification triggers accordingly
+        # Reload database in Discord bot & update notification triggers accordingly
         await self.discord_bot.refresh_data()
 
-        if self.debug_mode:
-            log("REFRESHED DISCORD_BOT")
+        logger.debug("Refreshed Discord bot")
 
 
-    async def run(self) -> None:
-        """Start-up procedure to run TG & Discord bots within the same event loop."""
+    async def count_update(self, update, context) -> None:
+        """Counts incoming updates by type for the metrics endpoint."""
+        if update.callback_query:
+            kind = "callback_query"
+        elif update.message and update.message.text and update.message.text.startswith("/"):
+            kind = "command"
+        elif update.message:
+            kind = "message"
+        else:
+            kind = "other"
+        metrics.TELEGRAM_UPDATES.labels(kind).inc()
+
+
+    def build_application(self, base_url=None) -> Application:
+        """
+        Builds the application incl. persistence & all handlers. base_url
+        replaces the Telegram API (i.e. a local stand-in for load tests).
+        """
 
         # Some config for the application
         config = PersistenceInput(
@@ -1007,16 +1111,25 @@ class TelegramBot:
             user_data=True,
             callback_data=True
         )
-        persistence = PicklePersistence(
+        persistence = SQLitePersistence(
             filepath=self.data_path,
             store_data=config,
             update_interval=30
         )
+        persistence.db.import_pickle(self.legacy_data_path)
         # Create the application and pass it your bot's token.
-        token = os.environ["TELEGRAM_BOT_TOKEN"]
-        self.application = (
-            Application.builder().token(token).persistence(persistence).build()
+        token = get_config().telegram_bot_token
+        builder = (
+            Application.builder()
+            .application_class(SerializedApplication)
+            .token(token)
+            .persistence(persistence)
+            # Updates of different users are handled in parallel, limited in SerializedApplication
+            .concurrent_updates(PENDING_UPDATES)
         )
+        if base_url:
+            builder = builder.base_url(base_url)
+        self.application = builder.build()
 
         # Define conversation handler with the states CHOOSING and TYPING_REPLY
         conv_handler = ConversationHandler(
@@ -1035,6 +1148,9 @@ class TelegramBot:
                     MessageHandler(filters.Regex("^Delete my data$"),
                         self.delete_my_data
                     ),
+                    MessageHandler(filters.Regex("^Delivery mode$"),
+                        self.delivery_menu
+                    ),
                     MessageHandler(filters.Regex("^(Discord channels|Discord roles)$"),
                         self.inline_submenu
                     ),
@@ -1088,9 +1204,54 @@ class TelegramBot:
         self.application.add_handler(show_source_handler)
         self.application.add_handler(debug_handler)
 
+        # Count every update before any other handler sees it
+        self.application.add_handler(TypeHandler(Update, self.count_update), group=-1)
+
+        return self.application
+
+
+    async def start_updates(self) -> None:
+        """Receives updates by webhook if TELEGRAM_WEBHOOK_URL is set, else by long polling."""
+        config = get_config()
+
+        if not config.telegram_webhook_url:
+            await self.application.updater.start_polling()
+            return
+
+        # Telegram posts updates to the public URL, proxied to the local listener
+        await self.application.updater.start_webhook(
+            listen=config.webhook_listen,
+            port=config.webhook_port,
+            url_path=urlparse(config.telegram_webhook_url).path.lstrip("/"),
+            webhook_url=config.telegram_webhook_url,
+            secret_token=config.webhook_secret,
+            # Parallel connections Telegram may open, matching the update concurrency
+            max_connections=config.concurrent_updates
+        )
+
+
+    async def run(self) -> None:
+        """Start-up procedure to run TG & Discord bots within the same event loop."""
+        self.build_application()
+
+        # Re-read .env on SIGHUP (always active channels, exempt roles, ...)
+        reload_on_sighup(asyncio.get_running_loop())
+
+        if get_config().metrics_port:
+            metrics.start_metrics_server(get_config().metrics_port)
+
         # Run application and discord bot simultaneously & asynchronously
         async with self.application:
             await self.application.initialize() # inits bot, update, persistence
             await self.application.start()
-            await self.application.updater.start_polling()
-            await self.start_discord_bot()
+            await self.oauth.start()
+            await self.start_updates()
+            time_to_ready = time.perf_counter() - self.started_at
+            logger.info(
+                "Telegram bot is receiving updates (%.2fs after start)", time_to_ready,
+                extra={"time_to_ready": round(time_to_ready, 3)}
+            )
+            try:
+                await self.start_discord_bot()
+            finally:
+                await self.oauth.close()